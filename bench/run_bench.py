@@ -0,0 +1,289 @@
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+# bench/ 下的脚本直接运行时，把仓库根目录加入模块搜索路径
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import numpy as np
+import PIL
+import shapely
+from constants import *
+from drawer import TileDrawer, filter_lines, filter_polygons
+from feature_index import FeatureIndex
+from feature_store import FeatureStore
+from labels import MEASURER, load_font
+from main import OSMHandler, read_header_bbox
+from projection import lonlat_to_mercator
+from raster import RENDERERS
+from synthetic_osm import add_city_arguments, city_from_args
+from tile_encoder import TileEncoder
+from tilegrid import tile_bounds, tile_range_for_bounds
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+QUERY_ZOOMS = [12, 14, 16, 18]
+DRAW_ZOOMS = [12, 14, 16, 18]
+CLIP_ZOOM = 16
+
+
+def sample_tiles(z, bbox, limit):
+    """
+    在缩放级别 z 下与 Web Mercator 边界 bbox 相交的瓦片中均匀取至多 limit 个，结果是确定的。
+    """
+    x_start, x_end, y_start, y_end = tile_range_for_bounds(z, bbox)
+    tiles = [(x, y) for x in range(x_start, x_end + 1) for y in range(y_start, y_end + 1)]
+    return tiles[::max(1, len(tiles) // limit)][:limit]
+
+
+def measure(fn, repeat, ops):
+    """
+    运行 fn repeat 次，取最短耗时，返回 {'seconds', 'ops', 'ms_per_op'}。
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return {'seconds': best, 'ops': ops, 'ms_per_op': best / ops * 1000}
+
+
+def ingest(osm_file, index, font_path):
+    # 每次摄入都从空的文本测量缓存开始
+    MEASURER.clear()
+    handler = OSMHandler(index, font_path)
+    handler.apply_file(osm_file, locations=True)
+    return handler
+
+
+def run_benchmarks(osm_file, city, font_path, repeat, tiles_per_zoom, renderers=('pillow',)):
+    results = {}
+    ways = len(city.ways)
+
+    results['ingest.header_bbox'] = measure(lambda: read_header_bbox(osm_file), repeat, 1)
+    results['ingest.index'] = measure(lambda: ingest(osm_file, FeatureIndex(), font_path), repeat, ways)
+
+    def ingest_store():
+        with tempfile.TemporaryDirectory() as tmp:
+            store = FeatureStore(os.path.join(tmp, 'features.db'))
+            ingest(osm_file, store, font_path)
+            store.close()
+    results['ingest.store'] = measure(ingest_store, repeat, ways)
+
+    index = FeatureIndex()
+    ingest(osm_file, index, font_path)
+    min_lon, min_lat, max_lon, max_lat = city.bounds()
+    xs, ys = lonlat_to_mercator([min_lon, max_lon], [min_lat, max_lat])
+    bbox = (float(xs[0]), float(ys[0]), float(xs[1]), float(ys[1]))
+
+    for z in QUERY_ZOOMS:
+        tiles = sample_tiles(z, bbox, tiles_per_zoom)
+        results[f'query.z{z}'] = measure(
+            lambda: [index.intersect(z, tile_bounds(z, x, y)) for x, y in tiles], repeat, len(tiles))
+
+    # 裁剪：先查询好各瓦片的要素，只计裁剪的耗时
+    tiles = sample_tiles(CLIP_ZOOM, bbox, tiles_per_zoom)
+    clip_layers = ['building', 'green_area', 'waterway', 'water_area', 'road']
+    layers = [(tile_bounds(CLIP_ZOOM, x, y), index.intersect(CLIP_ZOOM, tile_bounds(CLIP_ZOOM, x, y), clip_layers))
+              for x, y in tiles]
+    results[f'clip.polygons.z{CLIP_ZOOM}'] = measure(
+        lambda: [filter_polygons(features[feature_type], tile_bbox) for tile_bbox, features in layers
+                 for feature_type in ('building', 'green_area', 'water_area')], repeat, len(tiles))
+    results[f'clip.lines.z{CLIP_ZOOM}'] = measure(
+        lambda: [filter_lines(features[feature_type], tile_bbox) for tile_bbox, features in layers
+                 for feature_type in ('road', 'waterway')], repeat, len(tiles))
+
+    # 绘制：Pillow 的结果记为 draw.z*，其他后端记为 draw.<后端>.z*，采样的瓦片相同
+    font = load_font(font_path)
+    images = []
+    for name in renderers:
+        renderer = RENDERERS[name]
+        prefix = 'draw' if name == 'pillow' else f'draw.{name}'
+        for z in DRAW_ZOOMS:
+            tiles = sample_tiles(z, bbox, tiles_per_zoom)
+            results[f'{prefix}.z{z}'] = measure(
+                lambda: [TileDrawer(z, x, y, index, font, renderer=renderer) for x, y in tiles], repeat, len(tiles))
+            if name == 'pillow':
+                images.extend(image for image in (TileDrawer(z, x, y, index, font).result for x, y in tiles)
+                              if image is not None)
+
+    def encode():
+        # 纯色瓦片的编码缓存会掩盖编码耗时，每轮都用新的编码器
+        encoder = TileEncoder()
+        for image in images:
+            encoder.encode(image)
+    results['encode.png'] = measure(encode, repeat, max(1, len(images)))
+    return results
+
+
+SMOKE_SIZE = 64
+SMOKE_BACKGROUND = (255, 255, 255)
+
+
+def _square(x0, y0, x1, y1, clockwise=True):
+    ring = np.array([(x0, y0), (x1, y0), (x1, y1), (x0, y1), (x0, y0)], dtype=float)
+    return ring if clockwise else ring[::-1]
+
+
+def smoke_test(renderer, font):
+    """
+    用后端 renderer 绘制一个小场景并检查关键像素，返回不符合预期的检查说明列表（空列表表示通过）：
+    内环（与外环同向给出）留空、参数相同的重叠多边形不互相挖空、道路、文字，
+    以及文字和矢量图形交替绘制时两者都保留在 to_image 的结果中。
+    """
+    red, green, blue, black = (220, 0, 0), (0, 160, 0), (0, 0, 220), (0, 0, 0)
+    canvas = renderer(SMOKE_SIZE, SMOKE_BACKGROUND)
+    canvas.polygons([[_square(4, 24, 40, 60), _square(16, 36, 28, 48)]], [(red, None, 1)])
+    canvas.text((2, 0), "W", font, black)
+    canvas.polygons([[_square(44, 24, 56, 44)], [_square(50, 30, 62, 50, clockwise=False)]],
+                    [(green, None, 1), (green, None, 1)])
+    canvas.roads([np.array([(44.0, 56.0), (62.0, 56.0)])], [(6, blue)])
+    image = canvas.to_image()
+
+    checks = [
+        ((8, 28), red, "polygon fill"),
+        ((22, 42), SMOKE_BACKGROUND, "hole"),
+        ((53, 37), green, "overlapping polygons"),
+        ((53, 56), blue, "road"),
+    ]
+    failures = []
+    for (x, y), expected, what in checks:
+        actual = image.getpixel((x, y))
+        if max(abs(a - b) for a, b in zip(actual, expected)) > 8:
+            failures.append(f"{what}: pixel ({x}, {y}) is {actual}, expected {expected}")
+    text = np.asarray(image)[:20, :20]
+    if not (text.max(axis=2) < 128).any():
+        failures.append("text: no dark pixels where the label was drawn")
+    return failures
+
+
+def run_smoke_tests(renderers, font):
+    """
+    对每个后端运行 smoke_test 并打印结果，返回是否全部通过。
+    """
+    passed = True
+    for name in renderers:
+        failures = smoke_test(RENDERERS[name], font)
+        print(f"Renderer {name}: " + ("smoke test passed" if not failures else "smoke test FAILED"))
+        for failure in failures:
+            print(f"  {failure}")
+        passed = passed and not failures
+    return passed
+
+
+def compare(results, baseline, tolerance):
+    """
+    打印与基线的对比，返回变慢超过 tolerance 的基准测试名称列表。
+    """
+    regressions = []
+    print(f"{'benchmark':<22} {'ms/op':>10} {'baseline':>10} {'change':>8}")
+    for name, result in results.items():
+        base = baseline.get(name) if baseline else None
+        if base is None:
+            print(f"{name:<22} {result['ms_per_op']:10.3f} {'-':>10} {'-':>8}")
+            continue
+        change = result['ms_per_op'] / base['ms_per_op'] - 1
+        flag = ''
+        if change > tolerance:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print(f"{name:<22} {result['ms_per_op']:10.3f} {base['ms_per_op']:10.3f} {change:+8.1%}{flag}")
+    return regressions
+
+
+def compare_renderers(results, renderers):
+    """
+    按缩放级别并列打印各后端绘制一个瓦片的耗时，以及相对 Pillow 的加速比。
+    """
+    others = [name for name in renderers if name != 'pillow']
+    if not others or 'pillow' not in renderers:
+        return
+    print(f"{'zoom':<6} {'pillow':>10}" + ''.join(f" {name:>10} {'speedup':>8}" for name in others))
+    for z in DRAW_ZOOMS:
+        pillow = results[f'draw.z{z}']['ms_per_op']
+        row = f"z{z:<5} {pillow:10.3f}"
+        for name in others:
+            ms = results[f'draw.{name}.z{z}']['ms_per_op']
+            row += f" {ms:10.3f} {pillow / ms:7.2f}x"
+        print(row)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark ingest, index queries, clipping, tile drawing and encoding on a synthetic city, "
+                    "and compare the results with a stored baseline.")
+    add_city_arguments(parser)
+    parser.add_argument('--font', default=FONT_PATH,
+                        help="font used for labels; Pillow's default font is used when it can't be loaded")
+    parser.add_argument('--repeat', type=int, default=5, help="runs per benchmark, the fastest counts (default: 5)")
+    parser.add_argument('--tiles', type=int, default=100, help="tiles sampled per zoom level (default: 100)")
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE,
+                        help="baseline results to compare with (default: bench/baseline.json)")
+    parser.add_argument('--save-baseline', action='store_true', help="store these results as the new baseline")
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help="slowdown relative to the baseline reported as a regression (default: 0.25)")
+    parser.add_argument('--check', action='store_true', help="exit with status 1 when a benchmark regressed")
+    parser.add_argument('--json', metavar='PATH', help="also write the results to PATH")
+    parser.add_argument('--renderers', default=','.join(name for name, renderer in RENDERERS.items()
+                                                         if renderer.available()),
+                        help="comma-separated rasterization backends to benchmark tile drawing with "
+                             "(default: all installed)")
+    parser.add_argument('--smoke', action='store_true',
+                        help="only draw a small test scene with each renderer and check holes, overlapping rings, "
+                             "roads and text, exiting with status 1 on a failure")
+    args = parser.parse_args()
+    renderers = args.renderers.split(',')
+    for name in renderers:
+        if name not in RENDERERS or not RENDERERS[name].available():
+            parser.error(f"renderer '{name}' is unknown or not installed")
+
+    # 绘制结果不对的后端，耗时没有比较的意义
+    if not run_smoke_tests(renderers, load_font(args.font)):
+        sys.exit(1)
+    if args.smoke:
+        sys.exit(0)
+
+    city = city_from_args(args)
+    with tempfile.TemporaryDirectory() as tmp:
+        osm_file = os.path.join(tmp, 'city.osm')
+        city.write(osm_file)
+        print(f"Synthetic city: {len(city.nodes)} nodes, {len(city.ways)} ways.")
+        results = run_benchmarks(osm_file, city, args.font, args.repeat, args.tiles, renderers)
+
+    # 只有数据、采样的瓦片和字体都相同时结果才可比
+    report = {
+        'params': dict(city.params(), tiles=args.tiles,
+                       font=os.path.basename(args.font) if os.path.exists(args.font) else 'default'),
+        'environment': {'python': platform.python_version(), 'platform': platform.platform(),
+                        'shapely': shapely.__version__, 'pillow': PIL.__version__, 'repeat': args.repeat},
+        'results': results,
+    }
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+
+    baseline = None
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            stored = json.load(f)
+        if stored['params'] != report['params']:
+            print(f"Baseline '{args.baseline}' was measured with different parameters, not comparing.")
+        else:
+            baseline = stored['results']
+    regressions = compare(results, baseline, args.tolerance)
+    compare_renderers(results, renderers)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+        print(f"Saved baseline to '{args.baseline}'.")
+    if regressions:
+        print(f"{len(regressions)} benchmarks are more than {args.tolerance:.0%} slower than the baseline: "
+              + ", ".join(regressions))
+        if args.check:
+            sys.exit(1)
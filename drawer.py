@@ -1,303 +1,235 @@
-
-import math
-from pyproj import Transformer
-from shapely.geometry import LineString, Polygon, MultiPolygon, GeometryCollection, MultiLineString
-from PIL import Image, ImageDraw
+from collections import Counter
+import numpy as np
+import shapely
+from PIL import Image
 from constants import *
-
-def tile_to_bbox(z, x, y):
-    n = ZOOM_BASE ** z
-    lon_min = x / n * 360.0 - 180.0
-    lat_min = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y / n))))
-    lon_max = (x + 1) / n * 360.0 - 180.0
-    lat_max = math.degrees(
-        math.atan(math.sinh(math.pi * (1 - 2 * (y + 1) / n))))
-    return (lon_min, lat_min, lon_max, lat_max)
-
-
-def classify_items(items):
-    ret = {}
-    for item in items:
-        if item['type'] not in ret:
-            ret[item['type']] = []
-        ret[item['type']].append(item)
-    return ret
-
-
-def filter_polygons(items, tile_polygon):
-    ret = []
-    for item in items:
-        polygon = item['element']
-        if not polygon.intersects(tile_polygon):
+from feature_index import Features
+from labels import MEASURER, LabelPlacer, label_origin
+from profiling import timed
+from raster import PillowCanvas
+from style import load_style
+from tilegrid import tile_bounds, tile_affine, metatile_bounds
+
+# 几何类型对应的裁剪结果类型
+CLIP_TYPES = {
+    'polygon': shapely.GeometryType.POLYGON,
+    'line': shapely.GeometryType.LINESTRING,
+}
+
+# 能以一个多边形覆盖整个瓦片的绘制方式
+COVERING_TYPES = ('polygon', 'fill')
+
+
+def clip_to_tile(geoms, tile_bbox):
+    """
+    将一组几何裁剪到瓦片范围内，返回 (裁剪后的部件数组, 每个部件对应的几何下标)。
+    包围盒完全在瓦片内的几何直接保留，其余的用一次向量化的 clip_by_rect 裁剪。
+    """
+    geoms = geoms.copy()
+    min_x, min_y, max_x, max_y = tile_bbox
+    bounds = shapely.bounds(geoms)
+    inside = ((bounds[:, 0] >= min_x) & (bounds[:, 1] >= min_y) &
+              (bounds[:, 2] <= max_x) & (bounds[:, 3] <= max_y))
+    if not inside.all():
+        geoms[~inside] = shapely.clip_by_rect(geoms[~inside], min_x, min_y, max_x, max_y)
+    if inside.any():
+        # 裁剪结果的外环为顺时针，直接保留的多边形也统一为顺时针，保证描边的像素结果一致
+        geoms[inside] = shapely.orient_polygons(geoms[inside], exterior_cw=True)
+    return shapely.get_parts(geoms, return_index=True)
+
+
+def clip_features(features, tile_bbox, geom_type):
+    """
+    将一个图层的要素裁剪到瓦片范围内，返回类型为 geom_type 的非空部件，各部件保留所属要素的细分类型。
+    """
+    if not len(features):
+        return features
+    parts, owners = clip_to_tile(features.geoms, tile_bbox)
+    keep = (shapely.get_type_id(parts) == geom_type) & ~shapely.is_empty(parts)
+    return Features(parts[keep], features.kinds[owners[keep]], features.kind_names)
+
+
+def filter_polygons(features, tile_bbox):
+    return clip_features(features, tile_bbox, shapely.GeometryType.POLYGON)
+
+
+def filter_lines(features, tile_bbox):
+    return clip_features(features, tile_bbox, shapely.GeometryType.LINESTRING)
+
+
+def covering_fill(plan, layers, params, tile_bbox):
+    """
+    如果最后绘制的要素是一个完全覆盖瓦片的多边形，返回瓦片的填充色，否则返回 None。
+    裁剪后的覆盖多边形各边都在瓦片边界上，不会绘制轮廓，瓦片必然是纯色。
+    """
+    for layer_plan in reversed(plan.layers):
+        features = layers[layer_plan.layer]
+        if not len(features):
             continue
-        clipped = polygon.intersection(tile_polygon)
-        if clipped.is_empty:
-            continue
-
-        geom_types = []
-        if isinstance(clipped, (Polygon, MultiPolygon)):
-            geom_types.append(clipped)
-        elif isinstance(clipped, GeometryCollection):
-            geom_types.extend(
-                [geom for geom in clipped if isinstance(geom, (Polygon, MultiPolygon))])
-
-        for geom in geom_types:
-            if isinstance(geom, Polygon):
-                ret.append(
-                    {'element': geom, 'landuse_type': item.get('landuse_type')})
-            elif isinstance(geom, MultiPolygon):
-                for sub_geom in geom.geoms:
-                    ret.append(
-                        {'element': sub_geom, 'landuse_type': item.get('landuse_type')})
-    return ret
-
-
-def on_border(point):
-    return point[0] < EPS or 512 - point[0] < EPS or point[1] < EPS or 512 - point[1] < EPS
-
-
-def filter_lines(items, tile_polygon):
-    ret = []
-    for item in items:
-        line = item['element']
-        if not line.intersects(tile_polygon):
-            continue
-        clipped = line.intersection(tile_polygon)
-        if clipped.is_empty:
-            continue
-
-        if isinstance(clipped, LineString):
-            ret.append(
-                {'element': clipped, 'fined_type': item.get('fined_type')})
-        elif isinstance(clipped, MultiLineString):
-            for geom in clipped.geoms:
-                if isinstance(geom, LineString):
-                    ret.append(
-                        {'element': geom, 'fined_type': item.get('fined_type')})
-        elif isinstance(clipped, GeometryCollection):
-            for geom in clipped:
-                if isinstance(geom, LineString):
-                    ret.append(
-                        {'element': geom, 'fined_type': item.get('fined_type')})
-    return ret
+        if layer_plan.type not in COVERING_TYPES:
+            return None
+        fill = params[layer_plan.layer][features.kinds[-1]][0]
+        return fill if shapely.covers(features.geoms[-1], shapely.box(*tile_bbox)) else None
+    return None
 
 
 class TileDrawer:
-    def __init__(self, z, x, y, quadtrees, font):
-
-        # 计算瓦片边界
-        bbox = tile_to_bbox(z, x, y)
-        lon_min, lat_min, lon_max, lat_max = bbox
-
-        # 初始化坐标转换器（EPSG:4326 到 EPSG:3857）
-        transformer = Transformer.from_crs(
-            "epsg:4326", "epsg:3857", always_xy=True)
-
-        # 定义瓦片在Web Mercator中的边界
-        tile_min_x, tile_min_y = transformer.transform(lon_min, lat_min)
-        tile_max_x, tile_max_y = transformer.transform(lon_max, lat_max)
-        tile_bbox = (tile_min_x, tile_min_y, tile_max_x, tile_max_y)
-
-        # 定义缩放函数：从Web Mercator坐标到像素坐标
-        def scale(coord):
-            x_coord, y_coord = coord
-            px = (x_coord - tile_min_x) / (tile_max_x - tile_min_x) * img_size
-            py = (y_coord - tile_min_y) / (tile_max_y - tile_min_y) * img_size
-            return (px, py)
-        self.scale = scale
-
-        # 查询当前缩放级别的四叉树
-        items = classify_items(quadtrees[z].intersect(tile_bbox))
-
-        # 创建图像
-        img_size = 512
-        img = Image.new("RGB", (img_size, img_size), BACKGROUND_COLOR)
-        self.draw = ImageDraw.Draw(img)
-        drawed = False  # 标记是否绘制了任何元素
-
-        # 定义瓦片多边形，用于裁剪检查
-        tile_polygon = Polygon([
-            (tile_min_x, tile_min_y),
-            (tile_max_x, tile_min_y),
-            (tile_max_x, tile_max_y),
-            (tile_min_x, tile_max_y)
-        ])
-
-        # draw buildings
-        if 'building' in items:
-            buildings = filter_polygons(items['building'], tile_polygon)
-            drawed |= len(buildings) > 0
-            for building in buildings:
-                self.draw_polygon(
-                    building['element'], BUILDING_OUTLINE_COLOR, BUILDING_COLOR, BACKGROUND_COLOR)
-
-        # draw green areas
-        if 'green_area' in items:
-            green_areas = filter_polygons(items['green_area'], tile_polygon)
-            drawed |= len(green_areas) > 0
-            for green_area in green_areas:
-                self.draw_green_area(
-                    green_area['element'], green_area['landuse_type'])
-
-        # draw waterways
-        if 'waterway' in items:
-            waterways = filter_lines(items['waterway'], tile_polygon)
-            drawed |= len(waterways) > 0
-            for waterway in waterways:
-                self.draw_waterway(
-                    waterway['element'],  WATERWAY_COLOR, 4)
-
-        # draw water areas
-        if 'water_area' in items:
-            water_areas = filter_polygons(items['water_area'], tile_polygon)
-            drawed |= len(water_areas) > 0
-            for water_area in water_areas:
-                self.draw_water_area(water_area['element'])
-
-        # draw roads
-        if 'road' in items:
-            roads = filter_lines(items['road'], tile_polygon)
-            drawed |= len(roads) > 0
-            for road in roads:
-                road_type = road.get('fined_type', 'road')
-                width = ROAD_OUTLINE_WIDTH.get(
-                    road_type, ROAD_OUTLINE_DEFAULT_WIDTH)
-                width /= ZOOM_BASE ** (18 - z)
-                self.draw_road(road['element'],
-                               road_type, width, outline=True)
-
-            for road in roads:
-                road_type = road.get('fined_type', 'road')
-                width = ROAD_OUTLINE_WIDTH.get(
-                    road_type, ROAD_OUTLINE_DEFAULT_WIDTH)
-                width /= ZOOM_BASE ** (18 - z)
-                self.draw_road(road['element'], road_type, width)
-
-        if 'text' in items:
-            drawed |= len(items['text']) > 0
-            for text in items['text']:
-                self.draw_text(text['element'], font)
-
-        self.result = img if drawed else None
-
-    def draw_polygon(self, polygon, outline_color, fill_color, background_color):
-        """
-        绘制建筑物多边形及其内环。
-        """
-        def draw_polygon_outline(polygon: Polygon, color):
-
-            is_on_border = [on_border(point) for point in polygon]
-            for point_index in range(1, len(polygon)):
-                if is_on_border[point_index - 1] and is_on_border[point_index]:
-                    continue
-                self.draw.line([polygon[point_index - 1],
-                                polygon[point_index]], fill=color, width=2)
-
-        exterior = [self.scale(coord) for coord in polygon.exterior.coords]
-        self.draw.polygon(exterior, fill=fill_color)
-        draw_polygon_outline(exterior, color=outline_color)
-
-        # 绘制内环（孔洞）
-        for interior in polygon.interiors:
-            interior_coords = [self.scale(coord) for coord in interior.coords]
-            self.draw.polygon(interior_coords, fill=background_color)
-            draw_polygon_outline(interior_coords, color=outline_color)
-
-    def draw_green_area(self, polygon, landuse_type):
-        """
-        绘制绿地多边形。
-        """
-        fill_color = GREEN_AREA_COLORS.get(
-            landuse_type, GREEN_AREA_DEFAULT_COLOR)  # default to green
-        exterior = [self.scale(coord) for coord in polygon.exterior.coords]
-        self.draw.polygon(exterior, fill=fill_color)
+    """
+    按样式在缩放级别 z 的绘制计划绘制瓦片 (z, x, y)。size > 1 时绘制以 (x, y) 为左上角的 size×size 元瓦片：
+    只做一次索引查询和裁剪，在一张大画布上绘制，再由 tiles() 切分为单个瓦片。
+    没有要素时 result 为 None；整个画布被一个多边形覆盖时不绘制，fill 为其填充色。
+    几何转换为像素坐标后由 renderer（raster 中的画布类，默认 Pillow）光栅化。
+    """
+
+    def __init__(self, z, x, y, index, font, size=1, stats=None, style=None, renderer=None):
+        self.z, self.x, self.y, self.size = z, x, y, size
+        self.canvas_size = TILE_SIZE * size
+        # 各阶段的耗时和要素计数，累计到调用方传入的计数器（通常是该缩放级别的瓦片统计）
+        self.stats = stats = Counter() if stats is None else stats
+        self.plan = plan = (style or load_style()).plan(z)
+        self.background = plan.background
+
+        # 瓦片在Web Mercator中的边界和到像素坐标的仿射变换，均由 (z, x, y) 直接算出
+        tile_bbox = metatile_bounds(z, x, y, size)
+        origin_x, origin_y, pixel_scale = tile_affine(z, x, y)
+
+        self.origin = np.array([origin_x, origin_y])
+        # 像素坐标 = (坐标 - 原点) * 缩放，y 轴方向相反
+        self.pixel_scale = np.array([pixel_scale, -pixel_scale])
+
+        # 查询当前缩放级别下与瓦片相交的各图层要素（只查询绘制计划中的图层），并裁剪到瓦片范围
+        with timed(stats, 'render.query'):
+            layers = index.intersect(z, tile_bbox, plan.layer_names)
+        for feature_type, features in layers.items():
+            stats['features.' + feature_type] += len(features)
+        drawn = []
+        with timed(stats, 'render.clip'):
+            for layer_plan in plan.layers:
+                if layer_plan.type != 'text':
+                    layers[layer_plan.layer] = clip_features(layers[layer_plan.layer], tile_bbox,
+                                                             CLIP_TYPES[layer_plan.geometry])
+                    drawn.append(layers[layer_plan.layer].geoms)
+        with timed(stats, 'render.labels'):
+            for layer_plan in plan.layers:
+                if layer_plan.type == 'text':
+                    layers[layer_plan.layer], label_boxes = self.place_labels(layers[layer_plan.layer], font, tile_bbox)
+                    stats['labels.placed'] += len(layers[layer_plan.layer])
+                    drawn.append(label_boxes)
+
+        # 将要绘制的几何，用于判断各瓦片是否为空
+        self.drawn = np.concatenate(drawn) if drawn else np.empty(0, dtype=object)
+
+        # 各图层按细分类型编码取用的绘制参数
+        params = {layer_plan.layer: layer_plan.resolve(layers[layer_plan.layer].kind_names)
+                  for layer_plan in plan.layers}
+
+        # 绘制前的预检查：空瓦片不分配画布；被一个多边形完全覆盖的瓦片直接填充为纯色
+        self.fill = None
+        if not len(self.drawn):
+            self.image = self.result = None
+            return
+        self.fill = covering_fill(plan, layers, params, tile_bbox)
+        if self.fill is not None:
+            self.image = self.result = Image.new("RGB", (self.canvas_size, self.canvas_size), self.fill)
+            return
 
-        for interior in polygon.interiors:
-            interior_coords = [self.scale(coord) for coord in interior.coords]
-            self.draw.polygon(interior_coords, fill=BACKGROUND_COLOR)
+        # 创建画布
+        self.canvas = (renderer or PillowCanvas)(self.canvas_size, self.background)
 
-    def real_draw_road(self, line_pixels, width, color):
-        if width <= 0:
-            return
-        half_width = width // 2 - 0.5
+        # 按绘制计划的顺序逐图层绘制
+        for layer_plan in plan.layers:
+            features = layers[layer_plan.layer]
+            if not len(features):
+                continue
+            with timed(stats, layer_plan.stage):
+                getattr(self, 'draw_' + layer_plan.type + '_layer')(features, params[layer_plan.layer], font)
+
+        self.image = self.result = self.canvas.to_image()
 
-        if half_width > 0:
-            for point in line_pixels:
-                if not on_border(point):
-                    self.draw.ellipse([(point[0] - half_width, point[1] - half_width),
-                                       (point[0] + half_width, point[1] + half_width)], fill=color)
+    def draw_polygon_layer(self, features, params, font):
+        self.canvas.polygons([self.polygon_pixels(polygon) for polygon in features.geoms],
+                             [params[kind] for kind in features.kinds.tolist()])
 
-        for i in range(1, len(line_pixels)):
-            ext_1 = (50 * line_pixels[i - 1][0] - 49 * line_pixels[i]
-                     [0], 50 * line_pixels[i - 1][1] - 49 * line_pixels[i][1])
-            ext_2 = (50 * line_pixels[i][0] - 49 * line_pixels[i - 1]
-                     [0], 50 * line_pixels[i][1] - 49 * line_pixels[i - 1][1])
+    def draw_fill_layer(self, features, params, font):
+        # 只填充不描边
+        params = [(fill, None, 0) for fill, in params]
+        self.canvas.polygons([self.polygon_pixels(polygon) for polygon in features.geoms],
+                             [params[kind] for kind in features.kinds.tolist()])
 
-            p1 = ext_1 if on_border(line_pixels[i - 1]) else line_pixels[i - 1]
-            p2 = ext_2 if on_border(line_pixels[i]) else line_pixels[i]
-            self.draw.line([p1, p2], fill=color, width=int(width))
+    def draw_line_layer(self, features, params, font):
+        lines = [(self.to_pixels(line), params[kind]) for line, kind in zip(features.geoms, features.kinds.tolist())]
+        lines = [line for line in lines if len(line[0]) >= 2]
+        self.canvas.lines([pixels for pixels, _ in lines], [line_params for _, line_params in lines])
 
-    def draw_road(self, line, road_type, width, color=None, outline_color=None, outline=False):
+    def draw_road_layer(self, features, params, font):
         """
-        绘制道路（线条）。
+        道路分两遍绘制：先画全部道路的外框，再画内线，交叉口处内线连通。
         """
-        if len(line.coords) < 2:
-            return
-        line_pixels = [self.scale(coord) for coord in line.coords]
-
-        if color is None:
-            color = ROAD_COLORS.get(road_type, ROAD_DEFAULT_COLOR)
-        if outline_color is None:
-            outline_color = ROAD_OUTLINE_COLORS.get(
-                road_type, ROAD_OUTLINE_DEFAULT_COLOR)
-
-        if width <= 4:
-            if outline:
-                self.real_draw_road(line_pixels, width, color)
-        elif outline:
-            self.real_draw_road(line_pixels, width, outline_color)
-        else:
-            self.real_draw_road(line_pixels, width - 4, color)
-
-    def draw_waterway(self, line, color, width):
+        roads = [(self.to_pixels(line), params[kind]) for line, kind in zip(features.geoms, features.kinds.tolist())]
+        roads = [road for road in roads if len(road[0]) >= 2]
+        self.canvas.roads([pixels for pixels, _ in roads],
+                          [(width, casing_color) for _, (width, casing_color, _, _) in roads])
+        inner = [(pixels, (inner_width, color)) for pixels, (_, _, inner_width, color) in roads
+                 if inner_width is not None]
+        self.canvas.roads([pixels for pixels, _ in inner], [road_params for _, road_params in inner])
+
+    def draw_text_layer(self, features, params, font):
         """
-        绘制河流（线条）。
+        以标签位置为中心绘制文本，居中按文本的实际像素范围计算。
         """
-        if len(line.coords) < 2:
-            return
-        line_pixels = [self.scale(coord) for coord in line.coords]
-        self.draw.line(line_pixels, fill=color, width=width)
+        centers = (features.positions - self.origin) * self.pixel_scale
+        for label, (px, py), kind in zip(features.labels, centers.tolist(), features.kinds.tolist()):
+            if label:
+                self.canvas.text(label_origin(label, font, px, py), label, font, params[kind][0])
 
-    def draw_text(self, text_item, font):
+    def place_labels(self, texts, font, tile_bbox):
         """
-        在指定位置绘制文本标签。
+        在绘制任何文字之前确定要绘制的标签，返回 (放置的标签, 标签的 Web Mercator 范围)。
+        各标签按渲染字体测量、以位置为中心确定像素范围，再由 LabelPlacer 按优先级（建筑物面积）
+        剔除超出画布、相互重叠和超出数量上限的标签，每个画布的文字绘制量因此有上限。
         """
-        name = text_item.get('text', '')
-        position = text_item.get('position', (0, 0))
-        size = text_item.get('size', (0, 0))
-
-        if not name:
-            return  # 如果没有文本，跳过
-
-        # 计算像素位置
-        px, py = self.scale(position)
-
-        # 调整位置以居中文本
-        text_width, text_height = size
-        text_x = px - text_width / 2
-        text_y = py - text_height / 2
-
-        # 绘制文本
-        self.draw.text((text_x, text_y), name,
-                       font=font, fill="black")  # 示例文本颜色
-
-    def draw_water_area(self, polygon):
+        if not len(texts):
+            return texts, np.empty(0, dtype=object)
+        sizes = np.array([MEASURER.size(label, font) for label in texts.labels], dtype=float)
+        centers = (texts.positions - self.origin) * self.pixel_scale
+        boxes = np.hstack([centers - sizes / 2, centers + sizes / 2])
+        placer = LabelPlacer(self.canvas_size, self.canvas_size, LABEL_BUDGET * self.size ** 2)
+        keep = placer.place(boxes.tolist(), texts.priorities.tolist())
+        # 像素范围换回 Web Mercator，y 轴方向相反
+        lower = boxes[keep, :2] / self.pixel_scale + self.origin
+        upper = boxes[keep, 2:] / self.pixel_scale + self.origin
+        return (texts.take(np.array(keep, dtype=np.intp)),
+                shapely.box(lower[:, 0], upper[:, 1], upper[:, 0], lower[:, 1]))
+
+    def tiles(self):
+        """
+        将画布切分为单个瓦片，返回 {(x, y): 图像}，没有任何元素经过的瓦片为 None。
         """
-        绘制水域多边形。
+        if self.size == 1:
+            return {(self.x, self.y): self.result}
+        keys = [(self.x + i, self.y + j) for i in range(self.size) for j in range(self.size)]
+        if self.result is None:
+            return dict.fromkeys(keys)
+        boxes = shapely.box(*np.array([tile_bounds(self.z, x, y) for x, y in keys]).T)
+        # 只在瓦片边上相接的要素不算落入该瓦片，与单瓦片绘制时的裁剪结果一致
+        box_idx, geom_idx = shapely.STRtree(self.drawn).query(boxes, predicate='intersects')
+        interior = ~shapely.touches(boxes[box_idx], self.drawn[geom_idx])
+        hits = set(box_idx[interior].tolist())
+        ret = {}
+        for k, (x, y) in enumerate(keys):
+            i, j = x - self.x, y - self.y
+            box = (i * TILE_SIZE, j * TILE_SIZE, (i + 1) * TILE_SIZE, (j + 1) * TILE_SIZE)
+            ret[(x, y)] = self.image.crop(box) if k in hits else None
+        return ret
+
+    def to_pixels(self, geometry):
         """
-        exterior = [self.scale(coord) for coord in polygon.exterior.coords]
-        self.draw.polygon(exterior, fill=WATERWAY_COLOR)
+        将几何（线、环）的全部坐标一次性从Web Mercator转换为像素坐标，返回 (N, 2) 数组。
+        """
+        return (shapely.get_coordinates(geometry) - self.origin) * self.pixel_scale
 
-        for interior in polygon.interiors:
-            interior_coords = [self.scale(coord) for coord in interior.coords]
-            self.draw.polygon(interior_coords, fill=BACKGROUND_COLOR)
+    def polygon_pixels(self, polygon):
+        """
+        返回多边形各环的像素坐标 [外环, 内环, ...]。
+        """
+        return [self.to_pixels(polygon.exterior)] + [self.to_pixels(interior) for interior in polygon.interiors]
@@ -0,0 +1,252 @@
+import threading
+import numpy as np
+import shapely
+from constants import *
+
+# 缩放级别范围和细分类型编码的数据类型
+ZOOM_DTYPE = np.int8
+KIND_DTYPE = np.int16
+
+
+class Features:
+    """
+    同一图层的一组要素，按列存储。
+
+    geoms 为几何数组，文本图层为标签的索引范围；kinds 为细分类型编码，kind_names[kinds[i]] 为类型名，
+    编码 0 表示没有细分类型；min_zooms / max_zooms 为显示的缩放级别范围。
+    文本图层另有 labels（文字）、positions（位置，n×2）、sizes（像素尺寸，n×2）和 priorities（放置优先级）。
+    """
+    __slots__ = ('geoms', 'kinds', 'kind_names', 'min_zooms', 'max_zooms', 'labels', 'positions', 'sizes',
+                 'priorities')
+    COLUMNS = ('geoms', 'kinds', 'min_zooms', 'max_zooms', 'labels', 'positions', 'sizes', 'priorities')
+
+    def __init__(self, geoms, kinds, kind_names, min_zooms=None, max_zooms=None,
+                 labels=None, positions=None, sizes=None, priorities=None):
+        self.geoms = geoms
+        self.kinds = kinds
+        self.kind_names = kind_names
+        self.min_zooms = min_zooms
+        self.max_zooms = max_zooms
+        self.labels = labels
+        self.positions = positions
+        self.sizes = sizes
+        self.priorities = priorities
+
+    @classmethod
+    def from_columns(cls, name, geoms, kinds, kind_names, min_zooms, max_zooms,
+                     labels=(), positions=(), sizes=(), priorities=()):
+        """
+        由各列的列表构造图层 name 的要素，非文本图层忽略标签相关的列。
+        """
+        geom_array = np.empty(len(geoms), dtype=object)
+        geom_array[:] = geoms
+        features = cls(geom_array, np.array(kinds, dtype=KIND_DTYPE), kind_names,
+                       np.array(min_zooms, dtype=ZOOM_DTYPE), np.array(max_zooms, dtype=ZOOM_DTYPE))
+        if name == 'text':
+            features.labels = np.array(labels, dtype=object)
+            features.positions = np.array(positions, dtype=np.float64).reshape(-1, 2)
+            features.sizes = np.array(sizes, dtype=np.float64).reshape(-1, 2)
+            features.priorities = np.array(priorities, dtype=np.float64)
+        return features
+
+    def __len__(self):
+        return len(self.kinds)
+
+    def kind(self, i):
+        return self.kind_names[self.kinds[i]]
+
+    @classmethod
+    def empty(cls, name):
+        return cls.from_columns(name, [], [], [None], [], [])
+
+    def take(self, indices):
+        """
+        返回下标 indices 处的要素，与原要素共用细分类型表。
+        """
+        columns = {}
+        for name in self.COLUMNS:
+            column = getattr(self, name)
+            columns[name] = None if column is None else column[indices]
+        return Features(kind_names=self.kind_names, **columns)
+
+    @staticmethod
+    def concat(*parts):
+        """
+        按顺序连接多组要素，它们须共用同一个细分类型表。
+        """
+        columns = {}
+        for name in Features.COLUMNS:
+            column = getattr(parts[0], name)
+            columns[name] = None if column is None else np.concatenate([getattr(part, name) for part in parts])
+        return Features(kind_names=parts[-1].kind_names, **columns)
+
+
+def encode_kinds(kinds, kind_names=None, codes=None):
+    """
+    把细分类型的列表编码为整数列表，返回 (编码列表, 类型名列表)。
+    传入已有的 kind_names 和 {类型名: 编码} 表 codes 时，在其基础上追加新的类型。
+    """
+    if kind_names is None:
+        kind_names, codes = [None], {None: 0}
+    encoded = []
+    for kind in kinds:
+        code = codes.get(kind)
+        if code is None:
+            code = codes[kind] = len(kind_names)
+            kind_names.append(kind)
+        encoded.append(code)
+    return encoded, kind_names
+
+
+class LayerIndex:
+    """
+    一个图层的要素及其空间索引。新插入的要素先按行暂存，每攒够 chunk_size 个转换为列，
+    首次查询时合并各块并构建 STRtree；之后再插入要素会使索引失效，下次查询时重建。
+    几何图层按几何本身建索引，文本图层按标签的索引范围。
+    """
+
+    def __init__(self, name, chunk_size=65536):
+        self.name = name
+        self.chunk_size = chunk_size
+        self.kind_names = [None]
+        self._kind_codes = {None: 0}
+        self._rows = []
+        self._chunks = [Features.empty(name)]
+        self._chunks[0].kind_names = self.kind_names
+        self._tree = None
+        self._lock = threading.Lock()
+        self._empty = self._chunks[0]
+
+    def __getstate__(self):
+        # spawn 模式下只传递要素，空间索引由工作进程重建
+        features = self.features
+        return {'name': self.name, 'chunk_size': self.chunk_size, 'kind_names': self.kind_names,
+                '_kind_codes': self._kind_codes, '_chunks': [features]}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._rows = []
+        self._tree = None
+        self._lock = threading.Lock()
+        self._empty = Features.empty(self.name)
+
+    def append(self, geom, kind, min_zoom, max_zoom, label=None, position=None, size=None, priority=None):
+        self._rows.append((geom, kind, min_zoom, max_zoom, label, position, size, priority))
+        self._tree = None
+        if len(self._rows) >= self.chunk_size:
+            with self._lock:
+                self._flush_rows()
+
+    def _flush_rows(self):
+        if not self._rows:
+            return
+        rows, self._rows = self._rows, []
+        geoms, kinds, min_zooms, max_zooms, labels, positions, sizes, priorities = zip(*rows)
+        kinds, _ = encode_kinds(kinds, self.kind_names, self._kind_codes)
+        self._chunks.append(Features.from_columns(self.name, geoms, kinds, self.kind_names, min_zooms, max_zooms,
+                                                  labels, positions, sizes,
+                                                  [priority or 0 for priority in priorities]))
+
+    def _build(self):
+        """
+        合并暂存的要素，并在需要时重建 STRtree，返回 (要素, STRtree)。
+        多个线程（瓦片服务）可能同时查询，构建过程加锁。
+        """
+        with self._lock:
+            self._flush_rows()
+            if len(self._chunks) > 1:
+                self._chunks = [Features.concat(*self._chunks)]
+            if self._tree is None:
+                self._tree = shapely.STRtree(self._chunks[0].geoms)
+            return self._chunks[0], self._tree
+
+    @property
+    def features(self):
+        return self._build()[0]
+
+    def query(self, z, box):
+        """
+        返回缩放级别 z 下索引范围与矩形 box 相交的要素下标，按插入顺序排列。
+        """
+        features, tree = self._build()
+        indices = tree.query(box)
+        if len(indices):
+            indices = indices[(features.min_zooms[indices] <= z) & (features.max_zooms[indices] >= z)]
+            indices.sort()
+        return indices
+
+    def intersect(self, z, box):
+        indices = self.query(z, box)
+        if not len(indices):
+            # 小瓦片的大多数图层为空，共用同一个空结果
+            return self._empty
+        return self.features.take(indices)
+
+    def has_features(self, z, box):
+        """
+        是否有在缩放级别 z 或更高级别显示、且几何与已 prepare 的矩形 box 相交的要素。
+        """
+        features, tree = self._build()
+        indices = tree.query(box)
+        indices = indices[features.max_zooms[indices] >= z]
+        return bool(len(indices)) and bool(shapely.intersects(box, features.geoms[indices]).any())
+
+    def __len__(self):
+        return sum(len(chunk) for chunk in self._chunks) + len(self._rows)
+
+
+class FeatureIndex:
+    """
+    所有缩放级别共用的空间索引。
+
+    要素按图层分开按列存储，每个图层一个空间索引，图层在插入第一个要素时创建。每个要素只插入一次，
+    并记录其显示的缩放级别范围 [min_zoom, max_zoom]，查询时再按缩放级别过滤。
+    """
+
+    def __init__(self):
+        self.layers = {}
+        self.count = 0
+
+    def insert(self, item, bbox, min_zoom, max_zoom, osm_id=None):
+        """
+        插入一个要素。item 为 {'type': 图层, 'element': 几何或文本, 'kind': 细分类型}，
+        文本要素的 element 为 {'text', 'position', 'size', 'priority'}，以 bbox 作为其索引范围。
+        """
+        feature_type = item['type']
+        layer = self.layers.get(feature_type)
+        if layer is None:
+            layer = self.layers[feature_type] = LayerIndex(feature_type)
+        if feature_type == 'text':
+            text = item['element']
+            layer.append(shapely.box(*bbox), None, min_zoom, max_zoom,
+                         text['text'], text['position'], text['size'], text.get('priority'))
+        else:
+            layer.append(item['element'], item.get('kind'), min_zoom, max_zoom)
+        self.count += 1
+
+    def intersect(self, z, bbox, layers=None):
+        """
+        返回 {图层: Features}：缩放级别 z 下与 bbox 相交的各图层要素，图层内按插入顺序排列。
+        layers 为要查询的图层名列表，默认查询全部图层；没有要素的图层返回空的 Features。
+        """
+        box = shapely.box(*bbox)
+        if layers is None:
+            return {name: layer.intersect(z, box) for name, layer in self.layers.items()}
+        result = {}
+        for name in layers:
+            layer = self.layers.get(name)
+            result[name] = layer.intersect(z, box) if layer is not None else Features.empty(name)
+        return result
+
+    def has_features(self, z, bbox):
+        """
+        bbox 内是否有在缩放级别 z 或更高级别显示的要素，即以该范围为根的瓦片子树是否可能非空。
+        先按索引筛选，再检查几何是否真的与 bbox 相交，细长的对角线要素（河流、道路）
+        的边界框覆盖大片空白，只看边界框无法排除；文本标签按索引范围计。
+        """
+        box = shapely.box(*bbox)
+        shapely.prepare(box)
+        return any(layer.has_features(z, box) for layer in self.layers.values())
+
+    def __len__(self):
+        return self.count
@@ -0,0 +1,271 @@
+import json
+import os
+import sqlite3
+import threading
+import numpy as np
+import shapely
+from shapely.geometry import Point
+from feature_index import Features, encode_kinds
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS features (
+    id INTEGER PRIMARY KEY,
+    osm_id INTEGER,
+    type TEXT NOT NULL,
+    kind TEXT,
+    min_zoom INTEGER NOT NULL,
+    max_zoom INTEGER NOT NULL,
+    geom BLOB NOT NULL,
+    label TEXT,
+    label_width REAL,
+    label_height REAL,
+    label_priority REAL,
+    sort_key INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS features_osm_id ON features (osm_id);
+CREATE VIRTUAL TABLE IF NOT EXISTS features_rtree USING rtree(id, minx, maxx, miny, maxy);
+CREATE TABLE IF NOT EXISTS metadata (name TEXT PRIMARY KEY, value TEXT);
+"""
+
+# 可增量更新的要素库（main.py --updatable）另外记录入库路径的标签、节点列表和节点 -> 路径关系
+WAYS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS ways (id INTEGER PRIMARY KEY, tags TEXT NOT NULL, nodes BLOB NOT NULL);
+CREATE TABLE IF NOT EXISTS way_nodes (node_id INTEGER, way_id INTEGER, PRIMARY KEY (node_id, way_id)) WITHOUT ROWID;
+"""
+
+
+class FeatureStore:
+    """
+    基于 SQLite + R*Tree 的持久化要素库。
+
+    保存已投影、已分类的要素（类型、细分类型、缩放级别范围、WKB 几何和边界），
+    接口与 FeatureIndex 相同，渲染时可以直接打开而无需重新解析 OSM 文件。
+
+    要素按 sort_key 绘制：新要素取自己的 ID，增量更新时重新入库的要素沿用被替换要素的值，
+    绘制顺序因此与重新全量构建时相同。以 updatable=True 新建的要素库另把入库路径的标签和节点列表
+    存于 ways / way_nodes 表，供增量更新按移动的节点找到其所属路径；这一设置记录在 metadata 中。
+    """
+
+    def __init__(self, path, readonly=False, batch_size=10000, updatable=False):
+        self.path = path
+        self.readonly = readonly
+        self.batch_size = batch_size
+        self._rows = []
+        self._boxes = []
+        self._ways = []
+        self._way_nodes = []
+        # 增量更新中被删除的 OSM 对象 -> 其要素的 sort_key，重新入库时沿用
+        self._sort_keys = {}
+        self._local = threading.local()
+        if not readonly:
+            # 要素库可以随时从 OSM 文件重建，写入时不需要同步刷盘
+            self.connection().execute("PRAGMA synchronous = OFF")
+            self.connection().executescript(SCHEMA)
+            if updatable:
+                self.connection().executescript(WAYS_SCHEMA)
+                self.set_metadata('updatable', True)
+        columns = {row[1] for row in self.connection().execute("PRAGMA table_info(features)")}
+        if 'label_priority' not in columns:
+            raise ValueError(f"feature store '{path}' was built by an older version, rebuild it with --rebuild-store")
+        self.updatable = self.get_metadata('updatable', False)
+        self.count, self.last_id = self.connection().execute(
+            "SELECT COUNT(*), COALESCE(MAX(id), 0) FROM features").fetchone()
+
+    def connection(self):
+        # SQLite 连接不能跨进程、跨线程使用：fork 出的工作进程和瓦片服务的每个线程各自打开
+        local = self._local
+        if getattr(local, 'conn', None) is None or local.pid != os.getpid():
+            if self.readonly:
+                local.conn = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True)
+            else:
+                local.conn = sqlite3.connect(self.path)
+            local.pid = os.getpid()
+        return local.conn
+
+    def __getstate__(self):
+        # spawn 模式下只传递路径，由工作进程自行打开
+        return {'path': self.path, 'readonly': True, 'batch_size': self.batch_size}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def insert(self, item, bbox, min_zoom, max_zoom, osm_id=None):
+        self.count += 1
+        self.last_id += 1
+        feature_type = item['type']
+        if feature_type == 'text':
+            text = item['element']
+            geom = Point(text['position'])
+            label, (label_width, label_height) = text['text'], text['size']
+            label_priority = text.get('priority')
+        else:
+            geom = item['element']
+            label = label_width = label_height = label_priority = None
+        kind = item.get('kind')
+        sort_key = self._sort_keys.get(osm_id, self.last_id)
+        self._rows.append((self.last_id, osm_id, feature_type, kind, min_zoom, max_zoom,
+                           shapely.to_wkb(geom), label, label_width, label_height, label_priority, sort_key))
+        self._boxes.append((self.last_id, bbox[0], bbox[2], bbox[1], bbox[3]))
+        if len(self._rows) >= self.batch_size:
+            self.flush()
+
+    def add_way(self, way_id, tags, node_ids):
+        """
+        记录入库路径的标签和节点列表（仅 updatable 的要素库）。
+        """
+        self._ways.append((way_id, json.dumps(tags), np.array(node_ids, dtype=np.int64).tobytes()))
+        self._way_nodes += [(node_id, way_id) for node_id in set(node_ids)]
+        if len(self._ways) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self._rows and not self._ways:
+            return
+        conn = self.connection()
+        with conn:
+            conn.executemany("INSERT INTO features VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", self._rows)
+            conn.executemany("INSERT INTO features_rtree VALUES (?, ?, ?, ?, ?)", self._boxes)
+            if self._ways:
+                conn.executemany("INSERT OR REPLACE INTO ways VALUES (?, ?, ?)", self._ways)
+                # 按主键顺序插入，减少 B 树页的随机写入
+                self._way_nodes.sort()
+                conn.executemany("INSERT OR IGNORE INTO way_nodes VALUES (?, ?)", self._way_nodes)
+        self._rows = []
+        self._boxes = []
+        self._ways = []
+        self._way_nodes = []
+
+    def get_way(self, way_id):
+        """
+        返回记录的路径 (标签, 节点 ID 列表)，没有记录时返回 None。
+        """
+        row = self.connection().execute("SELECT tags, nodes FROM ways WHERE id = ?", (way_id,)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0]), np.frombuffer(row[1], dtype=np.int64).tolist()
+
+    def parent_ways(self, node_ids):
+        """
+        返回包含 node_ids 中任一节点的已记录路径 ID 集合。
+        """
+        self.flush()
+        conn = self.connection()
+        ways = set()
+        for node_id in node_ids:
+            ways.update(way_id for way_id, in conn.execute("SELECT way_id FROM way_nodes WHERE node_id = ?",
+                                                            (node_id,)))
+        return ways
+
+    def remove_way(self, way_id):
+        """
+        删除路径的标签和节点记录（路径被删除、或即将按新版本重新记录）。
+        """
+        self.flush()
+        way = self.get_way(way_id)
+        if way is None:
+            return
+        conn = self.connection()
+        with conn:
+            conn.execute("DELETE FROM ways WHERE id = ?", (way_id,))
+            conn.executemany("DELETE FROM way_nodes WHERE node_id = ? AND way_id = ?",
+                             [(node_id, way_id) for node_id in set(way[1])])
+
+    def remove(self, osm_id):
+        """
+        删除 OSM 对象 osm_id 产生的全部要素（包括各缩放级别的简化几何和名称标签），
+        返回被删除要素的 [(bbox, min_zoom, max_zoom), ...]。之后再插入的 osm_id 的要素沿用被删除要素的 sort_key。
+        """
+        self.flush()
+        conn = self.connection()
+        rows = conn.execute(
+            "SELECT f.id, r.minx, r.miny, r.maxx, r.maxy, f.min_zoom, f.max_zoom, f.sort_key "
+            "FROM features f JOIN features_rtree r ON r.id = f.id WHERE f.osm_id = ?", (osm_id,)).fetchall()
+        if rows:
+            self._sort_keys.setdefault(osm_id, min(row[7] for row in rows))
+            ids = [(row[0],) for row in rows]
+            with conn:
+                conn.executemany("DELETE FROM features WHERE id = ?", ids)
+                conn.executemany("DELETE FROM features_rtree WHERE id = ?", ids)
+            self.count -= len(rows)
+        return [(tuple(row[1:5]), row[5], row[6]) for row in rows]
+
+    def intersect(self, z, bbox, layers=None):
+        """
+        返回缩放级别 z 下与 bbox 相交的各图层要素，格式与 FeatureIndex.intersect 相同。
+        layers 为要查询的图层名列表，默认返回有要素的全部图层。
+        """
+        minx, miny, maxx, maxy = bbox
+        rows = self.connection().execute(
+            "SELECT f.type, f.kind, f.min_zoom, f.max_zoom, f.geom, f.label, f.label_width, f.label_height, "
+            "f.label_priority, r.minx, r.miny, r.maxx, r.maxy "
+            "FROM features_rtree r JOIN features f ON f.id = r.id "
+            "WHERE r.minx <= ? AND r.maxx >= ? AND r.miny <= ? AND r.maxy >= ? "
+            "AND f.min_zoom <= ? AND f.max_zoom >= ? ORDER BY f.sort_key, f.id",
+            (max(minx, maxx), min(minx, maxx), max(miny, maxy), min(miny, maxy), z, z)).fetchall()
+        if layers is None:
+            layers = {}
+            for row in rows:
+                layers.setdefault(row[0], []).append(row)
+        else:
+            layers = {name: [] for name in layers}
+            for row in rows:
+                if row[0] in layers:
+                    layers[row[0]].append(row)
+        return {name: self._features(name, layer_rows) for name, layer_rows in layers.items()}
+
+    @staticmethod
+    def _features(name, rows):
+        """
+        把同一图层的查询结果转换为列式的 Features。文本以 R*Tree 中的标签范围作为几何。
+        """
+        kinds, kind_names = encode_kinds([row[1] for row in rows])
+        min_zooms = [row[2] for row in rows]
+        max_zooms = [row[3] for row in rows]
+        if name != 'text':
+            return Features.from_columns(name, shapely.from_wkb([row[4] for row in rows]), kinds, kind_names,
+                                         min_zooms, max_zooms)
+        boxes = np.array([row[9:13] for row in rows], dtype=np.float64).reshape(-1, 4)
+        positions = shapely.get_coordinates(shapely.from_wkb([row[4] for row in rows]))
+        return Features.from_columns(name, shapely.box(boxes[:, 0], boxes[:, 1], boxes[:, 2], boxes[:, 3]),
+                                     kinds, kind_names, min_zooms, max_zooms, [row[5] for row in rows],
+                                     positions, [row[6:8] for row in rows], [row[8] or 0 for row in rows])
+
+    def has_features(self, z, bbox, batch_size=256):
+        """
+        bbox 内是否有在缩放级别 z 或更高级别显示的要素，即以该范围为根的瓦片子树是否可能非空。
+        先按 R*Tree 边界筛选，再分批检查几何是否真的与 bbox 相交，遇到第一个相交的要素即返回；
+        文本标签按边界框计。
+        """
+        minx, miny, maxx, maxy = bbox
+        cursor = self.connection().execute(
+            "SELECT f.type, f.geom FROM features_rtree r JOIN features f ON f.id = r.id "
+            "WHERE r.minx <= ? AND r.maxx >= ? AND r.miny <= ? AND r.maxy >= ? AND f.max_zoom >= ?",
+            (max(minx, maxx), min(minx, maxx), max(miny, maxy), min(miny, maxy), z))
+        tile = shapely.box(*bbox)
+        shapely.prepare(tile)
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                return False
+            if any(feature_type == 'text' for feature_type, _ in rows):
+                return True
+            if shapely.intersects(tile, shapely.from_wkb([geom for _, geom in rows])).any():
+                return True
+
+    def set_metadata(self, name, value):
+        conn = self.connection()
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO metadata VALUES (?, ?)", (name, json.dumps(value)))
+
+    def get_metadata(self, name, default=None):
+        row = self.connection().execute("SELECT value FROM metadata WHERE name = ?", (name,)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def close(self):
+        self.flush()
+        if getattr(self._local, 'conn', None) is not None:
+            self._local.conn.close()
+            self._local.conn = None
+
+    def __len__(self):
+        return self.count
@@ -0,0 +1,73 @@
+import numpy as np
+import shapely
+from constants import *
+from tilegrid import tile_span
+
+
+def pixel_size(z):
+    """
+    缩放级别 z 下一个像素在 Web Mercator 中的边长（米）。
+    """
+    return tile_span(z) / TILE_SIZE
+
+
+def generalize(geoms, is_polygon, min_zooms, max_zooms, stats=None):
+    """
+    按 GENERALIZATION_BANDS 为一批要素预先计算各缩放级别分段的简化几何。
+
+    返回与 geoms 等长的列表，每个元素为 [(几何, 起始缩放级别, 结束缩放级别), ...]，
+    按缩放级别升序排列；在某个分段内过小的要素不会出现在该分段中。
+    stats 不为 None 时，按缩放级别累计 [原始顶点数, 简化后顶点数, 丢弃的要素数]。
+    """
+    segments = [[] for _ in range(len(geoms))]
+    vertices = shapely.get_num_coordinates(geoms)
+
+    for band_start, band_end in GENERALIZATION_BANDS:
+        start = np.maximum(min_zooms, band_start)
+        end = np.minimum(max_zooms, band_end)
+        selected = np.flatnonzero(start <= end)
+        if len(selected) == 0:
+            continue
+
+        pixel = pixel_size(band_end)
+        tolerance = pixel * GENERALIZATION_TOLERANCE
+        polygons = is_polygon[selected]
+        simplified = np.empty(len(selected), dtype=object)
+        # 多边形需要保持拓扑以免简化后自相交，线则不需要
+        simplified[polygons] = shapely.simplify(geoms[selected[polygons]], tolerance, preserve_topology=True)
+        simplified[~polygons] = shapely.simplify(geoms[selected[~polygons]], tolerance, preserve_topology=False)
+        visible = ~shapely.is_empty(simplified) & np.where(
+            polygons,
+            shapely.area(simplified) >= GENERALIZATION_MIN_AREA * pixel * pixel,
+            shapely.length(simplified) >= pixel)
+
+        for i, geom, ok in zip(selected.tolist(), simplified, visible):
+            if ok:
+                segments[i].append((geom, int(start[i]), int(end[i])))
+
+        if stats is not None:
+            kept_vertices = np.where(visible, shapely.get_num_coordinates(simplified), 0)
+            for z in range(band_start, band_end + 1):
+                at_zoom = (start[selected] <= z) & (z <= end[selected])
+                counts = stats.setdefault(z, [0, 0, 0])
+                counts[0] += int(vertices[selected][at_zoom].sum())
+                counts[1] += int(kept_vertices[at_zoom].sum())
+                counts[2] += int((at_zoom & ~visible).sum())
+
+    # 分段以上的缩放级别使用原始几何
+    full_start = np.maximum(min_zooms, GENERALIZATION_BANDS[-1][1] + 1)
+    for i in np.flatnonzero(full_start <= max_zooms).tolist():
+        segments[i].append((geoms[i], int(full_start[i]), int(max_zooms[i])))
+    return segments
+
+
+def print_generalization_report(stats):
+    """
+    打印各缩放级别的顶点数变化。
+    """
+    for z in sorted(stats):
+        original, kept, dropped = stats[z]
+        if original == 0:
+            continue
+        reduction = (1 - kept / original) * 100 if original else 0.0
+        print(f"Zoom {z}: {original} -> {kept} vertices (-{reduction:.1f}%), {dropped} features dropped")
@@ -0,0 +1,157 @@
+import threading
+from collections import OrderedDict
+from PIL import Image, ImageDraw, ImageFont
+from constants import *
+from tilegrid import tile_span
+
+
+def font_key(font):
+    """
+    字体的缓存键：TrueType 字体按 (文件路径, 字号)，其他字体（如默认位图字体）按对象本身。
+    """
+    path = getattr(font, 'path', None)
+    if path is None:
+        return id(font)
+    return (path, font.size)
+
+
+# 已提示过加载失败的字体路径，每个进程只提示一次
+_missing_fonts = set()
+
+
+def load_font(path, size=FONT_SIZE):
+    """
+    加载 TrueType 字体。找不到字体文件时（例如在 Linux 上使用默认的 Windows 字体路径）
+    退回 Pillow 自带的默认字体，保证渲染可以在任何系统上运行。
+    """
+    try:
+        return ImageFont.truetype(path, size)
+    except OSError:
+        if path not in _missing_fonts:
+            _missing_fonts.add(path)
+            print(f"Failed to load font '{path}'. Using default font.")
+        try:
+            return ImageFont.load_default(size)
+        except TypeError:
+            # Pillow 10.1 之前的默认字体是固定大小的位图字体
+            return ImageFont.load_default()
+
+
+class TextMeasurer:
+    """
+    文本尺寸测量服务。所有测量共用一个 1×1 的绘图上下文，结果按 (文本, 字体, 字号) 缓存，
+    超过 max_entries 条时淘汰最久未用的。可以在瓦片服务的多个线程间共享。
+    """
+
+    def __init__(self, max_entries=65536):
+        self.max_entries = max_entries
+        self._draw = ImageDraw.Draw(Image.new('L', (1, 1)))
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def bbox(self, text, font):
+        """
+        返回文本以 (0, 0) 为锚点绘制时的像素范围 (left, top, right, bottom)。
+        """
+        key = (text, font_key(font))
+        with self._lock:
+            box = self._entries.get(key)
+            if box is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return box
+            self.misses += 1
+            box = self._draw.textbbox((0, 0), text, font=font)
+            self._entries[key] = box
+            if len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            return box
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def size(self, text, font):
+        left, top, right, bottom = self.bbox(text, font)
+        return right - left, bottom - top
+
+
+# 进程内共用的测量服务
+MEASURER = TextMeasurer()
+
+
+def label_origin(text, font, px, py, measurer=MEASURER):
+    """
+    使文本的实际像素范围以 (px, py) 为中心时 draw.text 的锚点位置。
+    """
+    left, top, right, bottom = measurer.bbox(text, font)
+    return px - (left + right) / 2, py - (top + bottom) / 2
+
+
+def label_extent(position, size, min_zoom):
+    """
+    标签在 min_zoom 及以上各级可能覆盖的 Web Mercator 范围，用作索引边界。
+    标签的像素尺寸固定，缩放级别越低占的地面范围越大，所以按 min_zoom 计算。
+    """
+    half_width, half_height = size[0] / 2, size[1] / 2
+    meters_per_pixel = tile_span(min_zoom) / TILE_SIZE
+    x, y = position
+    return (x - half_width * meters_per_pixel, y - half_height * meters_per_pixel,
+            x + half_width * meters_per_pixel, y + half_height * meters_per_pixel)
+
+
+class LabelPlacer:
+    """
+    画布上的标签放置：候选标签按优先级从高到低依次尝试，超出画布或与已放置的标签
+    （加上 padding 间距）重叠的跳过，放满 budget 个为止。
+    已放置的标签按 cell 像素的网格分桶，碰撞检测只比较所在格子里的标签。
+    """
+
+    def __init__(self, width, height, budget=LABEL_BUDGET, padding=LABEL_PADDING, cell=LABEL_GRID_CELL):
+        self.width = width
+        self.height = height
+        self.budget = budget
+        self.padding = padding
+        self.cell = cell
+        self.placed = []
+        self.grid = {}
+
+    def _cells(self, box):
+        left, top, right, bottom = box
+        cell = self.cell
+        return [(i, j) for i in range(int(left // cell), int(right // cell) + 1)
+                for j in range(int(top // cell), int(bottom // cell) + 1)]
+
+    def try_place(self, box):
+        """
+        尝试放置像素范围为 box 的标签，放置成功返回 True。
+        """
+        left, top, right, bottom = box
+        if right <= left or bottom <= top:
+            return False
+        if left < 0 or top < 0 or right > self.width or bottom > self.height:
+            return False
+        padding = self.padding
+        padded = (left - padding, top - padding, right + padding, bottom + padding)
+        for cell in self._cells(padded):
+            for other in self.grid.get(cell, ()):
+                if padded[0] < other[2] and other[0] < padded[2] and padded[1] < other[3] and other[1] < padded[3]:
+                    return False
+        self.placed.append(box)
+        for cell in self._cells(box):
+            self.grid.setdefault(cell, []).append(box)
+        return True
+
+    def place(self, boxes, priorities):
+        """
+        按优先级从高到低（相同时按原有顺序）放置一组标签，返回放置成功的下标。
+        """
+        keep = []
+        for i in sorted(range(len(boxes)), key=lambda i: -priorities[i]):
+            if len(self.placed) >= self.budget:
+                break
+            if self.try_place(boxes[i]):
+                keep.append(i)
+        return keep
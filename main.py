@@ -1,245 +1,747 @@
 import math
+import time
 import osmium
-from shapely.geometry import LineString, Polygon
-from shapely.ops import transform
-from pyproj import Transformer
-from PIL import Image, ImageDraw, ImageFont
+import numpy as np
+import shapely
+from PIL import Image
 import os
-import pyqtree
+import sys
+import argparse
+import io
+import multiprocessing
+from collections import Counter
+from contextlib import ExitStack
+from queue import Empty
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
 from constants import *
 from drawer import *
+from feature_index import FeatureIndex
+from feature_store import FeatureStore
+from projection import lonlat_to_mercator, mercator_to_lonlat
+from tilegrid import lonlat_to_tile
+from labels import MEASURER, label_extent, load_font
+from profiling import timed, peak_rss, build_report, write_report, print_stage_report, cprofiled, sampled, StackSampler
+from generalize import generalize, print_generalization_report
+from scheduler import schedule_tiles, print_schedule_report
+from raster import RENDERERS, get_renderer
+from style import DEFAULT_STYLE, load_style
+from tile_sink import QueueSink, open_sink, SINKS
+from tile_encoder import add_encoder_arguments, encoder_from_args
 
-def lonlat_to_tile(z, lon, lat):
+def read_header_bbox(osm_file):
     """
-    Convert longitude and latitude to tile x, y at zoom level z.
+    读取 OSM 文件头中的边界框（PBF 抽取文件通常带有），返回 (min_lon, min_lat, max_lon, max_lat)。
+    文件头没有边界框时返回 None。
     """
-    n = ZOOM_BASE ** z
-    x_tile = int((lon + 180.0) / 360.0 * n)
-    lat_rad = math.radians(lat)
-    y_tile = int((1.0 - math.log(math.tan(lat_rad) + (1 / math.cos(lat_rad))) / math.pi) / 2.0 * n)
-    # Clamp y_tile to [0, 2^z -1]
-    y_tile = max(0, min(int(n) - 1, y_tile))
-    return x_tile, y_tile
+    reader = osmium.io.Reader(osm_file, osmium.osm.osm_entity_bits.NOTHING)
+    try:
+        box = reader.header().box()
+    finally:
+        reader.close()
+    if not box.valid():
+        return None
+    return (box.bottom_left.lon, box.bottom_left.lat, box.top_right.lon, box.top_right.lat)
 
-class BoundingBoxHandler(osmium.SimpleHandler):
+def is_dense_file_index(node_index):
     """
-    Handler to compute the bounding box of an OSM file.
+    node_index 是否为文件支持的稠密节点索引（dense_file_array,<路径>）。
+    稀疏索引按 ID 追加，变更文件中移动的节点查到的仍是旧坐标，增量更新只能使用稠密索引。
     """
-    def __init__(self):
-        super(BoundingBoxHandler, self).__init__()
-        self.min_lon = math.inf
-        self.min_lat = math.inf
-        self.max_lon = -math.inf
-        self.max_lat = -math.inf
+    kind, _, path = node_index.partition(',')
+    return kind == 'dense_file_array' and bool(path)
 
-    def node(self, n):
-        if n.lon < self.min_lon:
-            self.min_lon = n.lon
-        if n.lon > self.max_lon:
-            self.max_lon = n.lon
-        if n.lat < self.min_lat:
-            self.min_lat = n.lat
-        if n.lat > self.max_lat:
-            self.max_lat = n.lat
-
-    def way(self, w):
-        for node in w.nodes:
-            self.node(node)
-
-    def relation(self, r):
-        for member in r.members:
-            if isinstance(member, osmium.osm.Node):
-                self.node(member)
+def project_coords(coords):
+    """
+    把 [(lon, lat), ...] 投影为 Web Mercator 坐标数组，形状为 (n, 2)。
+    """
+    lonlat = np.array(coords, dtype=np.float64).reshape(-1, 2)
+    return np.column_stack(lonlat_to_mercator(lonlat[:, 0], lonlat[:, 1]))
 
 class OSMHandler(osmium.SimpleHandler):
-    def __init__(self, transformer, quadtrees, font_path="arial.ttf", font_size=12):
+    def __init__(self, index, font_path="arial.ttf", font_size=FONT_SIZE, batch_size=10000, multipolygons=True,
+                 style=None):
         super(OSMHandler, self).__init__()
-        self.transformer = transformer
-        self.quadtrees = quadtrees
+        self.index = index
+        # 可增量更新的要素库（main.py --updatable）同时保存入库路径的标签和节点列表
+        self.record_ways = getattr(index, 'updatable', False)
+        # 入库规则来自样式，渲染时的绘制计划由同一份样式编译
+        self.style = style or load_style()
+        self.batch_size = batch_size
+        # 是否组装多边形关系；关闭时 osmium 只扫描一遍文件
+        self.multipolygons = multipolygons
         self.lines = []
         self.polygons = []
+        # 已入库要素的 Web Mercator 边界，摄入时顺带计算，省去单独扫描一遍文件
+        self.bounds = (math.inf, math.inf, -math.inf, -math.inf)
+        # 待处理的要素：经纬度先累积在 _coords 中，攒够一批后统一投影并构造几何
+        self._pending = []
+        self._coords = []
+        # 待处理的多边形关系：osmium 组装好的环的经纬度累积在 _area_coords 中，与路径一起分批投影
+        self._areas = []
+        self._area_coords = []
+        # 各缩放级别的概括统计：[原始顶点数, 简化后顶点数, 丢弃的要素数]
+        self.generalization_stats = {}
+        # 摄入各阶段的耗时和各类要素数
+        self.stats = Counter()
         
-        # 初始化字体
-        try:
-            self.font = ImageFont.truetype(font_path, font_size)
-            print(f"Loaded font '{font_path}' with size {font_size}.")
-        except IOError:
-            # 如果指定字体加载失败，使用默认字体
-            self.font = ImageFont.load_default()
-            print(f"Failed to load font '{font_path}'. Using default font.")
+        # 初始化字体，加载失败时使用默认字体
+        self.font = load_font(font_path, font_size)
+
+    def enabled_for(self):
+        entities = super(OSMHandler, self).enabled_for()
+        if not self.multipolygons:
+            entities &= ~osmium.osm.osm_entity_bits.AREA
+        return entities
+
+    def _handler_seconds(self):
+        return self.stats['classify.seconds'] + self.stats['area.seconds'] + self.stats['flush.seconds']
+
+    def apply_file(self, *args, **kwargs):
+        # 定义了 area 回调，osmium 会先扫描一遍关系，再在第二遍中用成员路径组装多边形关系。
+        # osmium 阶段为读取、解析文件、节点坐标查找和多边形组装的耗时，即总耗时减去回调中的处理耗时
+        start, handler_seconds = time.perf_counter(), self._handler_seconds()
+        super(OSMHandler, self).apply_file(*args, **kwargs)
+        self.stats['osmium.seconds'] += time.perf_counter() - start - (self._handler_seconds() - handler_seconds)
+        self.stats['osmium.calls'] += 1
+        self.flush()
+        rss = peak_rss()
+        if rss is not None:
+            self.stats['memory.peak_rss_bytes'] = max(self.stats['memory.peak_rss_bytes'], rss)
 
     def way(self, w):
-        # 处理道路
-        if 'highway' in w.tags:
-            road_type = w.tags['highway']
-            if road_type == 'construction' and 'construction' in w.tags:
-                road_type = w.tags['construction']
-                print('fallbacked to', road_type)
-            if road_type in ROAD_ZOOM_LEVELS:
-                coords = [(node.lon, node.lat) for node in w.nodes]
-                if len(coords) < 2:
-                    return
-                line = LineString(coords)
-                projected = transform(self.transformer.transform, line)
-                
-                # 将道路插入到对应的四叉树中
-                for z in ROAD_ZOOM_LEVELS[road_type]:
-                    self.quadtrees[z].insert({ 'type': 'road', 'element': projected, 'fined_type': road_type }, projected.bounds)
-
-        # 处理建筑物
-        if 'building' in w.tags:
-            coords = [(node.lon, node.lat) for node in w.nodes]
-            if len(coords) < 3:
-                return
-            if coords[0] != coords[-1]:
-                coords.append(coords[0])
-            polygon = Polygon(coords)
-            if not polygon.is_valid:
-                polygon = polygon.buffer(0)
-            projected = transform(self.transformer.transform, polygon)
-            
-            # 确定显示的缩放级别
-            min_z, max_z = 14, 18
-            
-            # 将建筑物插入到对应的四叉树中
-            for z in range(min_z, max_z + 1):
-                self.quadtrees[z].insert({ 'type': 'building', 'element': projected }, projected.bounds)
-            
-            # 处理建筑物名称标签
-            if 'name' in w.tags:
-                self._handle_building_name(projected, w.tags['name'], min_z + 3, max_z)
-
-        # 处理绿地
-        if 'landuse' in w.tags or 'leisure' in w.tags or 'natural' in w.tags:
-            landuse_type = w.tags.get('landuse') or w.tags.get('leisure') or w.tags.get('natural')
-            if landuse_type in GREEN_AREA_ZOOM_LEVELS:
-                coords = [(node.lon, node.lat) for node in w.nodes]
-                if len(coords) < 3:
-                    return
-                if coords[0] != coords[-1]:
-                    coords.append(coords[0])
-                polygon = Polygon(coords)
-                if not polygon.is_valid:
-                    polygon = polygon.buffer(0)
-                projected = transform(self.transformer.transform, polygon)
-                
-                for z in GREEN_AREA_ZOOM_LEVELS[landuse_type]:
-                    self.quadtrees[z].insert({ 'type': 'green_area', 'element': projected, 'landuse_type': landuse_type }, projected.bounds)
-        
-        # 处理河流
-        if 'waterway' in w.tags:
-            waterway_type = w.tags['waterway']
-            if waterway_type in WATERWAY_ZOOM_LEVELS:
-                coords = [(node.lon, node.lat) for node in w.nodes]
-                if len(coords) < 2:
-                    return
-                line = LineString(coords)
-                projected = transform(self.transformer.transform, line)
-                
-                for z in WATERWAY_ZOOM_LEVELS[waterway_type]:
-                    self.quadtrees[z].insert({ 'type': 'waterway', 'element': projected }, projected.bounds)
-
-        # 处理水域
-        if 'natural' in w.tags and w.tags['natural'] == 'water':
-            coords = [(node.lon, node.lat) for node in w.nodes]
-            if len(coords) < 3:
-                return
+        with timed(self.stats, 'classify'):
+            self.classify_way(w)
+        if len(self._pending) + len(self._areas) >= self.batch_size:
+            self.flush()
+
+    def area(self, a):
+        # 闭合路径组成的区域已由 way 处理，这里只处理多边形关系
+        if a.from_way():
+            return
+        with timed(self.stats, 'area'):
+            self.classify_area(a)
+        if len(self._pending) + len(self._areas) >= self.batch_size:
+            self.flush()
+
+    def classify_way(self, w):
+        """
+        按样式中各图层的规则判断路径属于哪些图层，把要素及其经纬度坐标加入待处理批次。
+        可增量更新的要素库还会记录入库路径的标签和节点，节点移动时据此重新入库其所属路径（见 update.py）。
+        """
+        matches = self.style.classify(w.tags)
+        if not matches:
+            return
+        if not self.record_ways:
+            self.queue_way(w.id, w.tags, [(node.lon, node.lat) for node in w.nodes], matches)
+            return
+        # 遍历 w.nodes 的开销较大，节点 ID 和坐标在同一遍中取出
+        node_ids, coords = [], []
+        for node in w.nodes:
+            node_ids.append(node.ref)
+            coords.append((node.lon, node.lat))
+        self.queue_way(w.id, w.tags, coords, matches)
+        self.index.add_way(w.id, dict(w.tags), node_ids)
+
+    def queue_way(self, way_id, tags, coords, matches):
+        """
+        把路径按 style.classify 的匹配结果加入待处理批次，各图层共用同一份节点坐标。
+        """
+        for rule, kind, min_z, max_z in matches:
+            if len(coords) < rule.min_points:
+                continue
+            label = None
+            if rule.label is not None:
+                tag, label_min_z, label_max_z = rule.label
+                text = tags.get(tag)
+                # 名称标签在几何构造完成后处理
+                label = (text, label_min_z, label_max_z) if text else None
+            self._queue({ 'type': rule.layer, 'kind': kind }, coords, rule.geometry == 'polygon', min_z, max_z, way_id,
+                        label)
+
+    def classify_area(self, a):
+        """
+        按样式中适用于多边形关系的规则（绿地、水域等）分类，把组装好的各个环加入待处理批次。
+        关系的要素以负的关系 ID 入库，以免与路径 ID 冲突。
+        """
+        rings = None  # 各图层共用同一份环坐标
+        for rule, kind, min_z, max_z in self.style.classify(a.tags, relations=True):
+            if rings is None:
+                rings = self._area_rings(a)
+            self._queue_area({ 'type': rule.layer, 'kind': kind }, rings, min_z, max_z, -a.orig_id())
+
+    @staticmethod
+    def _area_rings(a):
+        """
+        返回 [[外环坐标, 内环坐标, ...], ...]，每个外环及其内环构成一个多边形。
+        """
+        return [[[(node.lon, node.lat) for node in outer]]
+                + [[(node.lon, node.lat) for node in inner] for inner in a.inner_rings(outer)]
+                for outer in a.outer_rings()]
+
+    def _queue_area(self, item, rings, min_z, max_z, osm_id):
+        """
+        将一个多边形关系的环坐标加入待处理批次，只记录各环的顶点数，几何在 flush 中统一构造。
+        """
+        rings = [polygon for polygon in rings if len(polygon[0]) >= 4]
+        if not rings:
+            return
+        self._areas.append((item, min_z, max_z, osm_id, [[len(ring) for ring in polygon] for polygon in rings]))
+        self._area_coords.extend(point for polygon in rings for ring in polygon for point in ring)
+        self.stats['areas.relations'] += 1
+
+    def _queue(self, item, coords, is_polygon, min_z, max_z, osm_id, label=None):
+        """
+        将一个要素的经纬度坐标加入待处理批次，批次满后由 way 统一投影。
+        """
+        if is_polygon:
             if coords[0] != coords[-1]:
-                coords.append(coords[0])
-            polygon = Polygon(coords)
-            if not polygon.is_valid:
-                polygon = polygon.buffer(0)
-            projected = transform(self.transformer.transform, polygon)
-            
-            min_z, max_z = 10, 18  # 定义水��的缩放级别
-            
-            for z in range(min_z, max_z + 1):
-                self.quadtrees[z].insert({ 'type': 'water_area', 'element': projected }, projected.bounds)
-
-    def _handle_building_name(self, polygon, name, min_z, max_z):
-        """
-        根据建筑物大小和缩放级别计算文本标签的位置和尺寸，并插入到对应的四叉树中。
-        """
-        # 使用PIL计算文本尺寸
-        dummy_img = Image.new('RGB', (1, 1))
-        draw = ImageDraw.Draw(dummy_img)
-        bbox = draw.textbbox((0, 0), name, font=self.font)
-        text_width = bbox[2] - bbox[0]
-        text_height = bbox[3] - bbox[1]
-
-        # 获取建筑物多边形的质心
-        centroid = polygon.centroid
-        projected_centroid = centroid  # 假设多边形已投影
-
-        # 定义文本的边界框，居中于质心
-        minx = projected_centroid.x - text_width / 2
-        miny = projected_centroid.y - text_height / 2
-        maxx = projected_centroid.x + text_width / 2
-        maxy = projected_centroid.y + text_height / 2
-
-        # 将文本信息插入到对应缩放级别的四叉树中
-        for z in range(min_z, max_z +1):
-            self.quadtrees[z].insert({
-                'type': 'text',
-                'element': {
-                    'text': name,
-                    'position': (projected_centroid.x, projected_centroid.y),
-                    'size': (text_width, text_height)
-                }
-            }, (minx, miny, maxx, maxy))
-    
-    def relation(self, r):
-        # 可以根据需要实现关系（relation）的处理
-        pass
-            
-quadtrees = {z: pyqtree.Index(bbox=(-20037508.342789244, -20037508.342789244,
-                                    20037508.342789244, 20037508.342789244)) for z in range(1, 19)}
-
-def generate_tiles(z, x_start, x_end, y_start, y_end, quadtrees, output_dir='tiles'):
-    font = ImageFont.truetype("C:/Windows/fonts/Dengl.ttf", FONT_SIZE)
-    for x in range(x_start, x_end + 1):
-        for y in range(y_start, y_end + 1):
-            drawer = TileDrawer(z, x, y, quadtrees, font)
-            img = drawer.result
-            if img is not None:
-                tile_path = os.path.join(output_dir, str(z), str(x))
-                os.makedirs(tile_path, exist_ok=True)
-                img.save(os.path.join(tile_path, f"{y}.png"))
-                print(f"Saved tile {z}/{x}/{y}.png")
+                coords = coords + [coords[0]]
+            if len(coords) < 4:
+                return  # 无法构成线性环
+        self._pending.append((item, is_polygon, len(coords), min_z, max_z, osm_id, label))
+        self._coords.extend(coords)
+
+    def flush(self):
+        """
+        批量处理待处理的要素：用 NumPy 一次性投影所有坐标，
+        再用 Shapely 的向量化构造函数生成几何并写入空间索引。
+        """
+        if not self._pending and not self._areas:
+            return
+        start = time.perf_counter()
+        pending, self._pending = self._pending, []
+        with timed(self.stats, 'flush.project'):
+            coords, self._coords = project_coords(self._coords), []
+
+        with timed(self.stats, 'flush.geometry'):
+            is_polygon = np.array([entry[1] for entry in pending], dtype=bool)
+            counts = np.array([entry[2] for entry in pending], dtype=np.int64)
+            geom_index = np.repeat(np.arange(len(pending)), counts)
+            coord_is_polygon = np.repeat(is_polygon, counts)
+
+            geoms = np.empty(len(pending), dtype=object)
+            if not is_polygon.all():
+                shapely.linestrings(coords[~coord_is_polygon], indices=geom_index[~coord_is_polygon], out=geoms)
+            if is_polygon.any():
+                rings = np.empty(len(pending), dtype=object)
+                shapely.linearrings(coords[coord_is_polygon], indices=geom_index[coord_is_polygon], out=rings)
+                geoms[is_polygon] = shapely.polygons(rings[is_polygon])
+
+            # 多边形关系的几何：先构造各个环，再按外环、内环组成多边形，最后合并为 MultiPolygon
+            if self._areas:
+                with timed(self.stats, 'flush.geometry.areas'):
+                    areas, self._areas = self._areas, []
+                    area_coords, self._area_coords = project_coords(self._area_coords), []
+                    polygons = [polygon for entry in areas for polygon in entry[4]]
+                    ring_sizes = [size for polygon in polygons for size in polygon]
+                    rings = shapely.linearrings(area_coords, indices=np.repeat(np.arange(len(ring_sizes)), ring_sizes))
+                    parts = shapely.polygons(rings, indices=np.repeat(np.arange(len(polygons)),
+                                                                      [len(polygon) for polygon in polygons]))
+                    area_geoms = shapely.multipolygons(parts, indices=np.repeat(np.arange(len(areas)),
+                                                                                [len(entry[4]) for entry in areas]))
+                    pending.extend((item, True, 0, min_z, max_z, osm_id, None)
+                                   for item, min_z, max_z, osm_id, _ in areas)
+                    geoms = np.concatenate([geoms, area_geoms])
+                    is_polygon = np.concatenate([is_polygon, np.ones(len(areas), dtype=bool)])
+
+            invalid = is_polygon & ~shapely.is_valid(geoms)
+            if invalid.any():
+                geoms[invalid] = shapely.buffer(geoms[invalid], 0)
+
+            keep = ~shapely.is_empty(geoms)
+            bounds = shapely.bounds(geoms)
+            if keep.any():
+                self._extend_bounds((bounds[keep, 0].min(), bounds[keep, 1].min(),
+                                     bounds[keep, 2].max(), bounds[keep, 3].max()))
+
+        # 为低缩放级别预先计算简化几何，每个要素按缩放级别分段插入
+        with timed(self.stats, 'flush.generalize'):
+            min_zooms = np.array([entry[3] for entry in pending])
+            max_zooms = np.array([entry[4] for entry in pending])
+            segments = generalize(geoms[keep], is_polygon[keep], min_zooms[keep], max_zooms[keep],
+                                  self.generalization_stats)
+
+        with timed(self.stats, 'flush.index'):
+            for entry, geom, bbox, feature_segments in zip(
+                    [entry for entry, ok in zip(pending, keep) if ok], geoms[keep], bounds[keep].tolist(), segments):
+                item, _, _, _, _, osm_id, label = entry
+                self.stats['features.' + item['type']] += 1
+                for segment_geom, start_zoom, end_zoom in feature_segments:
+                    self.index.insert(dict(item, element=segment_geom), tuple(bbox), start_zoom, end_zoom,
+                                      osm_id=osm_id)
+
+                # 处理名称标签
+                if label is not None:
+                    self.stats['features.text'] += 1
+                    self._handle_label(geom, *label, osm_id)
+        self.stats['flush.seconds'] += time.perf_counter() - start
+        self.stats['flush.calls'] += 1
+
+    def _extend_bounds(self, bounds):
+        minx, miny, maxx, maxy = self.bounds
+        self.bounds = (min(minx, bounds[0]), min(miny, bounds[1]),
+                       max(maxx, bounds[2]), max(maxy, bounds[3]))
+
+    def data_bounds(self):
+        """
+        返回已入库要素的经纬度边界 (min_lon, min_lat, max_lon, max_lat)，没有任何要素时返回 None。
+        """
+        minx, miny, maxx, maxy = self.bounds
+        if minx > maxx:
+            return None
+        lon, lat = mercator_to_lonlat([minx, maxx], [miny, maxy])
+        return (float(lon[0]), float(lat[0]), float(lon[1]), float(lat[1]))
+
+    def _handle_label(self, geom, name, min_z, max_z, osm_id=None):
+        """
+        以要素质心为中心插入文本标签。标签尺寸是渲染字体下的像素尺寸，
+        实际位置在渲染时按像素坐标确定；索引边界取标签在 min_z 级覆盖的范围。
+        要素面积（如建筑物面积）作为标签的放置优先级。
+        """
+        centroid = geom.centroid
+        position = (centroid.x, centroid.y)
+        size = MEASURER.size(name, self.font)
+        self.index.insert({
+            'type': 'text',
+            'element': {
+                'text': name,
+                'position': position,
+                'size': size,
+                'priority': geom.area
+            }
+        }, label_extent(position, size, min_z), min_z, max_z, osm_id=osm_id)
+
+
+def merge_tile_stats(stats, other):
+    for z, counts in other.items():
+        stats.setdefault(z, Counter()).update(counts)
+
+def print_tile_report(stats):
+    """
+    打印各缩放级别跳过的空瓦片、引用已有数据的瓦片数和节省的字节数。
+    """
+    for z in sorted(stats):
+        counts = stats[z]
+        print(f"Zoom {z}: {counts['saved']} tiles saved, {counts['empty']} empty skipped, "
+              f"{counts['shared']} shared with other tiles ({counts['bytes_saved'] / 1024:.1f} KB saved)")
+
+def render_metatile(z, meta_x, meta_y, size, index, font, sink, wanted, stats, failures, delete_empty=False,
+                    style=None, renderer=None):
+    """
+    绘制以 (meta_x, meta_y) 为左上角的 size×size 元瓦片，把其中 wanted(x, y) 为真的瓦片写入 sink，
+    返回保存的瓦片数。delete_empty 为 True 时（增量更新）把变为空的瓦片从 sink 中删除。
+    """
+    saved = 0
+    zoom_stats = stats.setdefault(z, Counter())
+    try:
+        with timed(zoom_stats, 'render'):
+            drawer = TileDrawer(z, meta_x, meta_y, index, font, size, zoom_stats, style, renderer)
+            with timed(zoom_stats, 'render.slice'):
+                tiles = drawer.tiles()
+    except Exception as e:
+        failures.extend((z, x, y, repr(e))
+                        for x in range(meta_x, meta_x + size) for y in range(meta_y, meta_y + size)
+                        if wanted(x, y))
+        return saved
+    for (x, y), img in tiles.items():
+        if not wanted(x, y):
+            continue
+        try:
+            if img is None:
+                zoom_stats['empty'] += 1
+                if delete_empty:
+                    sink.delete(z, x, y)
+                continue
+            with timed(zoom_stats, 'write'):
+                sink.write(z, x, y, img, stats)
+        except Exception as e:
+            failures.append((z, x, y, repr(e)))
+            continue
+        saved += 1
+    return saved
+
+def render_tile_set(z, tiles, index, font, sink, metatile=1, delete_empty=False, style=None, renderer=None):
+    """
+    渲染集合 tiles 中的 (x, y) 瓦片，返回 (保存的瓦片数, 失败列表, 按缩放级别的统计)。
+    delete_empty 为 True 时（增量更新）变为空的瓦片会从 sink 中删除。
+    """
+    saved = 0
+    failures = []
+    stats = {z: Counter()}
+    size = min(metatile, ZOOM_BASE ** z)
+    for meta_x, meta_y in sorted({(x - x % size, y - y % size) for x, y in tiles}):
+        saved += render_metatile(z, meta_x, meta_y, size, index, font, sink, lambda x, y: (x, y) in tiles,
+                                 stats, failures, delete_empty=delete_empty, style=style, renderer=renderer)
+    return saved, failures, stats
+
+# 概览瓦片缩小时可选的重采样方法
+RESAMPLING = {
+    'nearest': Image.Resampling.NEAREST,
+    'box': Image.Resampling.BOX,
+    'bilinear': Image.Resampling.BILINEAR,
+    'hamming': Image.Resampling.HAMMING,
+    'bicubic': Image.Resampling.BICUBIC,
+    'lanczos': Image.Resampling.LANCZOS,
+}
+
+def build_overview_tile(z, x, y, sink, resample=Image.Resampling.LANCZOS, background=None):
+    """
+    将 z+1 级的四个子瓦片拼接后缩小一半，得到瓦片 (z, x, y)。
+    缺失的子瓦片按背景色（默认为默认样式的背景色）处理，四个子瓦片都不存在时返回 None。
+    """
+    canvas = None
+    for dx in (0, 1):
+        for dy in (0, 1):
+            data = sink.read(z + 1, 2 * x + dx, 2 * y + dy)
+            if data is None:
+                continue
+            if canvas is None:
+                canvas = Image.new("RGB", (2 * TILE_SIZE, 2 * TILE_SIZE), background or load_style().background)
+            with Image.open(io.BytesIO(data)) as child:
+                canvas.paste(child.convert("RGB"), (dx * TILE_SIZE, dy * TILE_SIZE))
+    if canvas is None:
+        return None
+    return canvas.resize((TILE_SIZE, TILE_SIZE), resample)
+
+def generate_overviews(z, x_start, x_end, y_start, y_end, sink, resample=Image.Resampling.LANCZOS, background=None):
+    """
+    用已生成的 z+1 级瓦片构建 z 级的概览瓦片，返回 (保存的瓦片数, 失败列表, 按缩放级别的统计)。
+    """
+    tiles = [(x, y) for x in range(x_start, x_end + 1) for y in range(y_start, y_end + 1)]
+    saved, failures, stats = rebuild_overviews(z, tiles, sink, resample, background=background)
+    print(f"Built {saved} overview tiles at zoom {z}")
+    return saved, failures, stats
+
+def rebuild_overviews(z, tiles, sink, resample=Image.Resampling.LANCZOS, delete_empty=False, background=None):
+    """
+    重新构建 z 级中 tiles 列出的概览瓦片。delete_empty 为 True 时（增量更新）删除子瓦片都已不存在的瓦片。
+    """
+    saved = 0
+    failures = []
+    stats = {z: Counter()}
+    for x, y in tiles:
+        try:
+            with timed(stats[z], 'overview'):
+                img = build_overview_tile(z, x, y, sink, resample, background)
+            if img is None:
+                stats[z]['empty'] += 1
+                if delete_empty:
+                    sink.delete(z, x, y)
+                continue
+            with timed(stats[z], 'write'):
+                sink.write(z, x, y, img, stats)
+        except Exception as e:
+            failures.append((z, x, y, repr(e)))
+            continue
+        saved += 1
+    return saved, failures, stats
+
+def pyramid_zoom(value):
+    """
+    --pyramid-zoom 的参数类型：至少最高级别（18）从矢量数据渲染，至少最低级别（1）由子瓦片缩小生成，
+    所以只接受 2 到 18。
+    """
+    z = int(value)
+    if not 2 <= z <= 18:
+        raise argparse.ArgumentTypeError("must be between 2 and 18")
+    return z
+
+# 工作进程的状态：由 _init_worker 在每个进程中设置一次
+_worker = {}
+
+def _init_worker(index, font_path, sink, metatile=1, style_path=DEFAULT_STYLE, renderer='pillow'):
+    """
+    工作进程初始化。fork 模式下 index 直接继承父进程内存（写时复制），
+    spawn 模式下则会被序列化后传入。字体和样式由各进程自行加载。
+    """
+    _worker['index'] = index
+    _worker['font'] = load_font(font_path)
+    _worker['style'] = load_style(style_path)
+    _worker['renderer'] = get_renderer(renderer)
+    _worker['sink'] = sink
+    _worker['metatile'] = metatile
+
+def _render_chunk(z, tiles):
+    saved, failures, stats = render_tile_set(z, set(tiles), _worker['index'], _worker['font'], _worker['sink'],
+                                             _worker['metatile'], style=_worker['style'],
+                                             renderer=_worker['renderer'])
+    return z, tiles[0][0], tiles[-1][0], saved, failures, stats
+
+def split_tiles(tiles, chunks, align=1):
+    """
+    将按 x 排序的瓦片列表切分为大约 chunks 块，每块的瓦片数接近，各块覆盖互不重叠的列范围。
+    块只在元瓦片（宽 align 列）之间切开，保证同一个元瓦片不会被拆到两个块中。
+    """
+    target = max(1, len(tiles) // chunks)
+    chunk = []
+    for tile in tiles:
+        if len(chunk) >= target and tile[0] // align != chunk[-1][0] // align:
+            yield chunk
+            chunk = []
+        chunk.append(tile)
+    if chunk:
+        yield chunk
+
+def generate_tiles_parallel(tile_sets, index, sink, workers, font_path=FONT_PATH, metatile=1,
+                            style_path=DEFAULT_STYLE, renderer='pillow'):
+    """
+    使用进程池并行渲染多个缩放级别的瓦片。
+    tile_sets: {z: [(x, y), ...]}，各级别要渲染的瓦片，按 x 排序（schedule_tiles 的结果）
+    每个缩放级别按列切块后提交到进程池。支持并发写入的输出（目录）由工作进程直接写入；
+    否则工作进程只编码 PNG，经队列交给父进程写入。
+    父进程汇总进度、失败信息和统计，返回 (保存的瓦片数, 失败列表, 按缩放级别的统计)。
+    """
+    if 'fork' in multiprocessing.get_all_start_methods():
+        ctx = multiprocessing.get_context('fork')
+    else:
+        ctx = multiprocessing.get_context()
+
+    tasks = []
+    for z, tiles in sorted(tile_sets.items()):
+        # 每个工作进程大约分到 4 块，兼顾负载均衡和调度开销
+        for chunk in split_tiles(tiles, workers * 4, min(metatile, ZOOM_BASE ** z)):
+            tasks.append((z, chunk))
+
+    # 队列有上限，父进程写入跟不上时工作进程会等待，避免编码好的瓦片堆积在内存中
+    queue = None if sink.concurrent else ctx.Queue(maxsize=workers * 64)
+    worker_sink = sink if queue is None else QueueSink(queue, sink.encoder)
+
+    total_saved = 0
+    all_failures = []
+    all_stats = {}
+    received = 0
+    with ProcessPoolExecutor(max_workers=workers, mp_context=ctx,
+                             initializer=_init_worker,
+                             initargs=(index, font_path, worker_sink, metatile, style_path, renderer)) as executor:
+        pending = {executor.submit(_render_chunk, *task) for task in tasks}
+        done = 0
+        # 所有块都完成、且队列中的瓦片都已写入后才结束
+        while pending or (queue is not None and received < total_saved):
+            if queue is not None:
+                try:
+                    z, x, y, data = queue.get(timeout=0.1)
+                except Empty:
+                    pass
+                else:
+                    # 工作进程中的 write 阶段只包括编码和入队，写入输出的耗时单独计
+                    with timed(all_stats.setdefault(z, Counter()), 'write.store'):
+                        sink.write_data(z, x, y, data, all_stats)
+                    received += 1
+                    continue
+                finished = {future for future in pending if future.done()}
+            else:
+                finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                pending.remove(future)
+                done += 1
+                z, xs, xe, saved, failures, stats = future.result()
+                total_saved += saved
+                all_failures.extend(failures)
+                merge_tile_stats(all_stats, stats)
+                print(f"[{done}/{len(tasks)}] zoom {z}, x {xs}-{xe}: saved {saved} tiles"
+                      + (f", {len(failures)} failed" if failures else ""))
+    return total_saved, all_failures, all_stats
+
+def finish_run(args, started, profilers, osm_handler=None, tile_stats=None):
+    """
+    停止分析器，打印摄入和渲染中最耗时的阶段，指定 --report 时写出 JSON 运行报告。
+    """
+    profilers.close()
+    ingest_stats = osm_handler.stats if osm_handler is not None else None
+    if ingest_stats:
+        print_stage_report("Ingest stages", ingest_stats)
+        if ingest_stats['areas.relations']:
+            print(f"Assembled {ingest_stats['areas.relations']} multipolygon relations.")
+        if ingest_stats['memory.peak_rss_bytes']:
+            print(f"Peak RSS after ingest: {ingest_stats['memory.peak_rss_bytes'] / 2 ** 20:.1f} MB")
+    if tile_stats:
+        total = Counter()
+        for counts in tile_stats.values():
+            total.update(counts)
+        print_stage_report("Render stages (all zooms)", total)
+    if args.report:
+        run = {
+            'osm_file': args.osm_file,
+            'store': args.store,
+            'output': args.output,
+            'encoder': encoder_from_args(args).describe(),
+            'workers': args.workers,
+            'metatile': args.metatile,
+            'pyramid_zoom': args.pyramid_zoom,
+            'wall_seconds': time.perf_counter() - started,
+        }
+        generalization_stats = osm_handler.generalization_stats if osm_handler is not None else None
+        write_report(args.report, build_report(run, ingest_stats, tile_stats, generalization_stats))
 
 if __name__ == "__main__":
-    osm_file = 'map.osm'
-    out_folder = 'tile'
-    # osm_file = 'shanghai-latest.osm'
-    # out_folder = 'shanghai'
+    parser = argparse.ArgumentParser(description="Render OSM data into z/x/y.png tiles.")
+    parser.add_argument('osm_file', nargs='?', default='map.osm', help="input OSM file (default: map.osm)")
+    parser.add_argument('-o', '--output', default='tile',
+                        help="output z/x/y.png directory, or an .mbtiles / .pmtiles archive (default: tile)")
+    parser.add_argument('--format', choices=sorted(SINKS),
+                        help="output format; inferred from the --output extension by default, "
+                             "'dir' keeps the z/x/y.png tree used by the Leaflet viewer")
+    add_encoder_arguments(parser)
+    parser.add_argument('--workers', type=int, default=1,
+                        help="number of rendering processes; 1 renders in the main process (default: 1)")
+    parser.add_argument('--font', default=FONT_PATH, help="font used for labels")
+    parser.add_argument('--style', default=DEFAULT_STYLE,
+                        help="style file with the layers to ingest and how to draw them (default: style.json)")
+    parser.add_argument('--renderer', choices=sorted(RENDERERS), default='pillow',
+                        help="rasterization backend; agg draws antialiased batched paths and needs aggdraw "
+                             "(default: pillow)")
+    parser.add_argument('--node-index', default='sparse_mem_array',
+                        help="osmium node location index, e.g. sparse_mem_array, dense_mmap_array "
+                             "or dense_file_array,nodes.idx for planet-scale inputs; --updatable needs the "
+                             "dense file-backed index (default: sparse_mem_array)")
+    parser.add_argument('--no-multipolygons', dest='multipolygons', action='store_false',
+                        help="skip multipolygon relations (lakes, forests, riverbanks made of several ways); "
+                             "saves osmium's extra pass over the relations")
+    parser.add_argument('--store', help="SQLite feature store; built from the OSM file if missing, "
+                                        "otherwise opened directly without parsing the OSM file")
+    parser.add_argument('--rebuild-store', action='store_true', help="rebuild the feature store even if it exists")
+    parser.add_argument('--ingest-only', action='store_true', help="only build the feature store, don't render tiles")
+    parser.add_argument('--updatable', action='store_true',
+                        help="also record way tags and node lists in the new feature store so update.py can apply "
+                             ".osc change files to it; needs --node-index dense_file_array,<path>")
+    parser.add_argument('--pyramid-zoom', type=pyramid_zoom, metavar='Z',
+                        help="render only zoom Z (2-18) and above from vector data; lower zooms are built by "
+                             "downsampling their four child tiles")
+    parser.add_argument('--resample', choices=sorted(RESAMPLING), default='lanczos',
+                        help="resampling filter for downsampled overview tiles (default: lanczos)")
+    parser.add_argument('--metatile', type=int, default=1, metavar='N',
+                        help="draw N×N blocks of tiles on one canvas and slice them; N must be a power of two "
+                             "(default: 1)")
+    parser.add_argument('--report', metavar='PATH',
+                        help="write a JSON report with per-stage timings and counts per zoom level")
+    parser.add_argument('--profile', metavar='PATH',
+                        help="run the main process under cProfile and write the stats to PATH; "
+                             "use --workers 1 to include rendering")
+    parser.add_argument('--sample', metavar='PATH',
+                        help="sample the main process's call stacks and write them to PATH in the folded "
+                             "format used by flamegraph.pl and speedscope (not available on Windows)")
+    parser.add_argument('--sample-interval', type=float, default=0.005, metavar='SECONDS',
+                        help="CPU time between stack samples (default: 0.005)")
+    args = parser.parse_args()
+    if args.metatile < 1 or args.metatile & (args.metatile - 1):
+        parser.error("--metatile must be a power of two")
+    if args.ingest_only and not args.store:
+        parser.error("--ingest-only requires --store")
+    if args.updatable and not args.store:
+        parser.error("--updatable requires --store")
+    if args.updatable and not is_dense_file_index(args.node_index):
+        parser.error("--updatable needs the dense file-backed node index, --node-index dense_file_array,<path>; "
+                     "sparse indexes return the old location of nodes moved by a change file")
+    if args.sample and not StackSampler.available():
+        parser.error("--sample needs signal.setitimer, which this platform doesn't provide")
+    osm_file = args.osm_file
+    try:
+        style = load_style(args.style)
+        renderer = get_renderer(args.renderer)
+    except (OSError, ValueError) as e:
+        parser.error(str(e))
+
+    started = time.perf_counter()
+    profilers = ExitStack()
+    if args.profile:
+        profilers.enter_context(cprofiled(args.profile))
+    if args.sample:
+        profilers.enter_context(sampled(args.sample, args.sample_interval))
+    osm_handler = None
     
-    # 确定 OSM 数据的边界框
-    bbox_handler = BoundingBoxHandler()
-    bbox_handler.apply_file(osm_file, locations=True, idx='sparse_mem_array')
-    min_lon, min_lat = bbox_handler.min_lon, bbox_handler.min_lat
-    max_lon, max_lat = bbox_handler.max_lon, bbox_handler.max_lat
+    if args.store and os.path.exists(args.store) and not args.rebuild_store:
+        # 直接打开已有的要素库，跳过 OSM 解析
+        index = FeatureStore(args.store, readonly=True)
+        bbox = index.get_metadata('bounds')
+        print(f"Opened feature store '{args.store}' with {len(index)} features.")
+    else:
+        # 初始化空间索引，所有缩放级别共用；指定 --store 时写入磁盘
+        if args.store:
+            if os.path.exists(args.store):
+                os.remove(args.store)
+            index = FeatureStore(args.store, updatable=args.updatable)
+        else:
+            index = FeatureIndex()
+
+        # 一次扫描加载所有相关元素到空间索引中，同时得到数据边界
+        osm_handler = OSMHandler(index, args.font, multipolygons=args.multipolygons, style=style)
+        osm_handler.apply_file(osm_file, locations=True, idx=args.node_index)
+        print_generalization_report(osm_handler.generalization_stats)
+
+        # 确定 OSM 数据的边界框：优先使用文件头中的边界框
+        bbox = read_header_bbox(osm_file) or osm_handler.data_bounds()
+        if args.store:
+            index.set_metadata('bounds', bbox)
+            index.close()
+            print(f"Wrote {len(index)} features to '{args.store}'.")
+            if args.ingest_only:
+                finish_run(args, started, profilers, osm_handler)
+                sys.exit(0)
+            index = FeatureStore(args.store, readonly=True)
+
+    if bbox is None:
+        print("No renderable features found.")
+        finish_run(args, started, profilers, osm_handler)
+        sys.exit(0)
+    min_lon, min_lat, max_lon, max_lat = bbox
     print(f"OSM Data Bounding Box:")
     print(f"Min Longitude: {min_lon}, Min Latitude: {min_lat}")
     print(f"Max Longitude: {max_lon}, Max Latitude: {max_lat}")
 
-    # 初始化多个四叉树
-    quadtrees = {z: pyqtree.Index(bbox=(-20037508.342789244, -20037508.342789244,
-                                         20037508.342789244,  20037508.342789244)) for z in range(1, 19)}
-
-    # 加载所有相关元素到四叉树中
-    transformer = Transformer.from_crs("epsg:4326", "epsg:3857", always_xy=True)
-    osm_handler = OSMHandler(transformer, quadtrees, "C:/Windows/fonts/Dengl.ttf")
-    osm_handler.apply_file(osm_file, locations=True, idx='sparse_mem_array')
-
-    # 为每个缩放级别生成瓦片
+    # 将边界框转换为每个缩放级别的瓦片索引范围
+    tile_ranges = []
     for z in range(1, 19):
-        # 将边界框转换为瓦片索引范围
         x_start, y_start = lonlat_to_tile(z, min_lon, max_lat)
         x_end, y_end = lonlat_to_tile(z, max_lon, min_lat)
         print(f"Tile Range at Zoom {z}:")
         print(f"x_start: {x_start}, x_end: {x_end}")
         print(f"y_start: {y_start}, y_end: {y_end}")
+        tile_ranges.append((z, x_start, x_end, y_start, y_end))
 
-        generate_tiles(z, x_start, x_end, y_start, y_end, quadtrees, out_folder)
-    
+    # 金字塔模式下只有 pyramid_zoom 及以上的缩放级别从矢量数据渲染
+    render_ranges = [r for r in tile_ranges if args.pyramid_zoom is None or r[0] >= args.pyramid_zoom]
+    overview_ranges = [r for r in tile_ranges if r not in render_ranges]
+
+    sink = open_sink(args.output, args.format, bbox, tile_ranges[0][0], tile_ranges[-1][0],
+                     encoder_from_args(args))
+
+    # 自顶向下遍历金字塔，跳过索引中没有要素的子树，只调度可能非空的瓦片
+    schedule_start = time.perf_counter()
+    tile_sets, schedule_stats = schedule_tiles(index, render_ranges)
+    print_schedule_report(schedule_stats)
+    print(f"Scheduled {sum(len(tiles) for tiles in tile_sets.values())} tiles "
+          f"in {time.perf_counter() - schedule_start:.2f}s.")
+
+    # 为每个缩放级别生成瓦片
+    if args.workers > 1:
+        saved, failures, tile_stats = generate_tiles_parallel(tile_sets, index, sink, args.workers,
+                                                              args.font, args.metatile, args.style, args.renderer)
+    else:
+        saved, failures, tile_stats = 0, [], {}
+        font = load_font(args.font)
+        for z, tiles in sorted(tile_sets.items()):
+            z_saved, z_failures, z_stats = render_tile_set(z, set(tiles), index, font, sink, args.metatile,
+                                                           style=style, renderer=renderer)
+            saved += z_saved
+            failures.extend(z_failures)
+            merge_tile_stats(tile_stats, z_stats)
+    merge_tile_stats(tile_stats, schedule_stats)
+
+    # 从高到低逐级由子瓦片缩小生成概览瓦片
+    for z, x_start, x_end, y_start, y_end in reversed(overview_ranges):
+        z_saved, z_failures, z_stats = generate_overviews(z, x_start, x_end, y_start, y_end, sink,
+                                                          RESAMPLING[args.resample], style.background)
+        saved += z_saved
+        failures.extend(z_failures)
+        merge_tile_stats(tile_stats, z_stats)
+    sink.close()
+
+    print_tile_report(tile_stats)
+    finish_run(args, started, profilers, osm_handler, tile_stats)
+
+    for z, x, y, error in failures:
+        print(f"Failed tile {z}/{x}/{y}.png: {error}")
+    if failures:
+        print(f"Generated {saved} tiles, {len(failures)} failed.")
+        sys.exit(1)
     print("Generated all tiles successfully!")
@@ -0,0 +1,168 @@
+import cProfile
+import json
+import os
+import pstats
+import signal
+import sys
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+@contextmanager
+def timed(counter, stage):
+    """
+    把代码块的耗时累计到 counter[stage + '.seconds']，执行次数累计到 counter[stage + '.calls']。
+    阶段名用 '.' 分级，例如 render.draw.road 是 render.draw 的一部分。
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        counter[stage + '.seconds'] += time.perf_counter() - start
+        counter[stage + '.calls'] += 1
+
+
+def peak_rss():
+    """
+    返回当前进程到目前为止的峰值常驻内存（字节），平台不支持时返回 None。
+    """
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux 上单位为 KB，macOS 上为字节
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def split_counters(counter):
+    """
+    把计数器拆分为 ({阶段: {'calls', 'seconds', 'ms_per_call'}}, {其他计数})。
+    """
+    stages, counts = {}, {}
+    for key, value in counter.items():
+        name, _, field = key.rpartition('.')
+        if field in ('seconds', 'calls'):
+            stages.setdefault(name, {'calls': 0, 'seconds': 0.0})[field] = value
+        else:
+            counts[key] = value
+    for stage in stages.values():
+        stage['ms_per_call'] = stage['seconds'] / stage['calls'] * 1000 if stage['calls'] else None
+    return dict(sorted(stages.items())), dict(sorted(counts.items()))
+
+
+def build_report(run, ingest_stats=None, tile_stats=None, generalization_stats=None):
+    """
+    生成机器可读的运行报告：运行参数、摄入各阶段耗时和要素数、各缩放级别的渲染阶段耗时和瓦片计数，
+    以及所有缩放级别的合计。
+    """
+    report = {'run': run}
+    if ingest_stats is not None:
+        stages, counts = split_counters(ingest_stats)
+        report['ingest'] = {'stages': stages, 'counts': counts}
+    if generalization_stats:
+        report['generalization'] = {
+            str(z): {'vertices': original, 'kept_vertices': kept, 'dropped_features': dropped}
+            for z, (original, kept, dropped) in sorted(generalization_stats.items())}
+    if tile_stats is not None:
+        total = Counter()
+        report['zooms'] = {}
+        for z in sorted(tile_stats):
+            total.update(tile_stats[z])
+            stages, counts = split_counters(tile_stats[z])
+            report['zooms'][str(z)] = {'stages': stages, 'counts': counts}
+        stages, counts = split_counters(total)
+        report['total'] = {'stages': stages, 'counts': counts}
+    return report
+
+
+def write_report(path, report):
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+    print(f"Wrote run report to '{path}'.")
+
+
+def print_stage_report(title, counter, limit=12):
+    """
+    按累计耗时从高到低打印最耗时的阶段。
+    """
+    stages, _ = split_counters(counter)
+    if not stages:
+        return
+    print(f"{title}:")
+    for name, stage in sorted(stages.items(), key=lambda item: -item[1]['seconds'])[:limit]:
+        print(f"  {name:<28} {stage['seconds']:9.3f} s {stage['calls']:9d} calls {stage['ms_per_call']:9.3f} ms/call")
+
+
+@contextmanager
+def cprofiled(path):
+    """
+    在代码块执行期间启用 cProfile，结束后把统计写入 path（可用 pstats、snakeviz 等查看），
+    并打印累计耗时最高的函数。只统计当前进程。
+    """
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield profiler
+    finally:
+        profiler.disable()
+        profiler.dump_stats(path)
+        print(f"Wrote cProfile stats to '{path}'.")
+        pstats.Stats(profiler).sort_stats('cumulative').print_stats(15)
+
+
+class StackSampler:
+    """
+    基于 SIGPROF 定时器的采样分析器：每消耗 interval 秒 CPU 时间记录一次当前调用栈，
+    按 flamegraph.pl / speedscope 使用的折叠栈格式输出。开销与函数调用次数无关，
+    适合观察长时间运行的整体热点。只采样当前进程的主线程，需要 setitimer（Windows 不支持）。
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.stacks = Counter()
+        self._previous = None
+
+    @staticmethod
+    def available():
+        return hasattr(signal, 'setitimer')
+
+    def _sample(self, signum, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+            frame = frame.f_back
+        self.stacks[';'.join(reversed(stack))] += 1
+
+    def start(self):
+        self._previous = signal.signal(signal.SIGPROF, self._sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self):
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, self._previous or signal.SIG_DFL)
+
+    def write(self, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+        print(f"Wrote {sum(self.stacks.values())} stack samples to '{path}'.")
+
+
+@contextmanager
+def sampled(path, interval=0.005):
+    """
+    在代码块执行期间用 StackSampler 采样，结束后把折叠栈写入 path。
+    """
+    sampler = StackSampler(interval)
+    sampler.start()
+    try:
+        yield sampler
+    finally:
+        sampler.stop()
+        sampler.write(path)
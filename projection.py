@@ -0,0 +1,28 @@
+import numpy as np
+from constants import *
+
+EARTH_RADIUS = 6378137.0
+# Web Mercator 能表示的最大纬度，超出部分截断
+MAX_LATITUDE = 85.0511287798066
+
+
+def lonlat_to_mercator(lon, lat):
+    """
+    EPSG:4326 到 EPSG:3857（球面墨卡托）的闭式投影，lon/lat 可以是标量或 NumPy 数组。
+    """
+    lon = np.asarray(lon, dtype=np.float64)
+    lat = np.clip(np.asarray(lat, dtype=np.float64), -MAX_LATITUDE, MAX_LATITUDE)
+    x = np.radians(lon) * EARTH_RADIUS
+    y = np.log(np.tan(np.pi / 4 + np.radians(lat) / 2)) * EARTH_RADIUS
+    return x, y
+
+
+def mercator_to_lonlat(x, y):
+    """
+    EPSG:3857 到 EPSG:4326 的逆投影。
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    lon = np.degrees(x / EARTH_RADIUS)
+    lat = np.degrees(2 * np.arctan(np.exp(y / EARTH_RADIUS)) - np.pi / 2)
+    return lon, lat
@@ -0,0 +1,253 @@
+import numpy as np
+from PIL import Image, ImageColor, ImageDraw
+from constants import *
+
+try:
+    import aggdraw
+except ImportError:  # 可选依赖：pip install aggdraw
+    aggdraw = None
+
+
+def border_mask(pixels, size=TILE_SIZE):
+    """
+    返回像素坐标数组 (N, 2) 中位于画布（边长 size）边界上的点的布尔掩码。
+    """
+    return ((pixels < EPS) | (size - pixels < EPS)).any(axis=1)
+
+
+def segment_runs(mask):
+    """
+    返回布尔数组中连续 True 段的 (起始下标, 结束下标) 列表，结束下标不包含在内。
+    """
+    edges = np.flatnonzero(np.diff(np.concatenate([[False], mask, [False]]).astype(np.int8)))
+    return edges.reshape(-1, 2).tolist()
+
+
+def outline_runs(ring, size):
+    """
+    返回环上需要描边的 (起始下标, 结束下标) 列表：两端都在画布边界上的边是裁剪产生的，不描边，
+    其余连续的边合并为一条折线，折线包含下标 start 到 stop 的点。
+    """
+    on_border = border_mask(ring, size)
+    if not on_border.any():
+        return [(0, len(ring) - 1)]
+    return segment_runs(~(on_border[:-1] & on_border[1:]))
+
+
+def param_runs(params):
+    """
+    返回参数列表中参数相同的连续段 (起始下标, 结束下标)，结束下标不包含在内。
+    矢量后端把每段合并为一条路径绘制，同时保持要素之间的绘制顺序。
+    """
+    runs = []
+    start = 0
+    for i in range(1, len(params) + 1):
+        if i == len(params) or params[i] != params[start]:
+            runs.append((start, i))
+            start = i
+    return runs
+
+
+class PillowCanvas:
+    """
+    Pillow ImageDraw 画布：逐个几何绘制，不抗锯齿。道路的圆角由每个顶点上的圆模拟，
+    位于画布边界上的端点沿线段方向外延，避免相邻瓦片接缝处出现缺口。
+
+    各绘制方法的几何都是像素坐标数组 (N, 2)，多边形为 [外环, 内环, ...]，
+    params 为各几何的绘制参数，与几何一一对应。
+    """
+    name = 'pillow'
+
+    def __init__(self, size, background):
+        self.size = size
+        self.background = background
+        self.image = Image.new("RGB", (size, size), background)
+        self.draw = ImageDraw.Draw(self.image)
+
+    @staticmethod
+    def available():
+        return True
+
+    def polygons(self, polygons, params):
+        """
+        绘制多边形，params 为 (填充色, 轮廓色, 轮廓宽度)，轮廓色为 None 时只填充。
+        内环（孔洞）填充为背景色。
+        """
+        for rings, (fill, outline, outline_width) in zip(polygons, params):
+            for k, ring in enumerate(rings):
+                self.draw.polygon(ring.ravel().tolist(), fill=fill if k == 0 else self.background)
+                if outline is not None:
+                    for start, stop in outline_runs(ring, self.size):
+                        self.draw.line(ring[start:stop + 1].ravel().tolist(), fill=outline, width=outline_width)
+
+    def lines(self, lines, params):
+        """
+        以固定线宽绘制线条，params 为 (颜色, 线宽)。
+        """
+        for line, (color, width) in zip(lines, params):
+            self.draw.line(line.ravel().tolist(), fill=color, width=width)
+
+    def roads(self, lines, params):
+        """
+        绘制带圆角的粗线，params 为 (线宽, 颜色)。
+        """
+        for line, (width, color) in zip(lines, params):
+            self.road(line, width, color)
+
+    def road(self, line_pixels, width, color):
+        if width <= 0:
+            return
+        half_width = width // 2 - 0.5
+        on_border = border_mask(line_pixels, self.size)
+
+        if half_width > 0:
+            for (px, py), border in zip(line_pixels.tolist(), on_border):
+                if not border:
+                    self.draw.ellipse([(px - half_width, py - half_width),
+                                       (px + half_width, py + half_width)], fill=color)
+
+        # 位于瓦片边界上的端点沿线段方向外延，避免相邻瓦片接缝处出现缺口
+        start, end = line_pixels[:-1], line_pixels[1:]
+        p1 = np.where(on_border[:-1, None], 50 * start - 49 * end, start)
+        p2 = np.where(on_border[1:, None], 50 * end - 49 * start, end)
+
+        # 在边界上的中间点处断开，其余连续线段合并为一条折线绘制
+        breaks = np.flatnonzero(on_border[1:-1]) + 1
+        for first, last in zip(np.concatenate([[0], breaks]), np.concatenate([breaks, [len(line_pixels) - 1]])):
+            points = line_pixels[first:last + 1].copy()
+            points[0], points[-1] = p1[first], p2[last - 1]
+            self.draw.line(points.ravel().tolist(), fill=color, width=int(width))
+
+    def text(self, origin, text, font, color):
+        self.draw.text(origin, text, font=font, fill=color)
+
+    def to_image(self):
+        return self.image
+
+
+def _rgb(color):
+    # 样式中的颜色可以是 (r, g, b) 或 Pillow 认识的颜色名，aggdraw 只认识 CSS 颜色名
+    if isinstance(color, str):
+        color = ImageColor.getrgb(color)
+    return tuple(color[:3])
+
+
+def _ring_coords(ring, clockwise):
+    """
+    返回环的扁平坐标列表，必要时反转点序，使环按 clockwise 指定的方向排列。
+    """
+    x, y = ring[:, 0], ring[:, 1]
+    # 像素坐标的 y 轴向下，鞋带公式的面积为正时环是顺时针的
+    if (np.dot(x[:-1], y[1:]) - np.dot(x[1:], y[:-1]) > 0) != clockwise:
+        ring = ring[::-1]
+    return ring.ravel().tolist()
+
+
+def _add_polyline(path, points):
+    path.moveto(*points[0])
+    for x, y in points[1:]:
+        path.lineto(x, y)
+
+
+class AggCanvas:
+    """
+    AGG 画布（需要 aggdraw）：参数相同的连续几何合并为一条路径，一次填充或描边，并且抗锯齿。
+    文字仍由 Pillow 按同一字体绘制。
+
+    多边形用非零环绕规则填充：外环和内环按相反方向加入路径，孔洞不再覆盖为背景色，
+    相互重叠的多边形也不会互相挖空。aggdraw 的画笔只有平头端点和尖角连接，
+    道路在画布内部的端点另外补一个圆点。
+    """
+    name = 'agg'
+
+    def __init__(self, size, background):
+        if aggdraw is None:
+            raise ValueError("the agg renderer needs aggdraw (pip install aggdraw)")
+        self.size = size
+        self.background = background
+        self.draw = aggdraw.Draw("RGB", (size, size), _rgb(background))
+        # 绘制文字时把画布转换为 Pillow 图像，之后再绘制矢量图形时写回
+        self._image = None
+
+    @staticmethod
+    def available():
+        return aggdraw is not None
+
+    def _vector(self):
+        if self._image is not None:
+            self.draw.frombytes(self._image.tobytes())
+            self._image = None
+        return self.draw
+
+    def polygons(self, polygons, params):
+        draw = self._vector()
+        for start, stop in param_runs(params):
+            fill, outline, outline_width = params[start]
+            path = aggdraw.Path()
+            for rings in polygons[start:stop]:
+                for k, ring in enumerate(rings):
+                    path.polygon(_ring_coords(ring, clockwise=k == 0))
+            draw.path(path, None, aggdraw.Brush(_rgb(fill)))
+            if outline is None:
+                continue
+            path = aggdraw.Path()
+            for rings in polygons[start:stop]:
+                for ring in rings:
+                    for first, last in outline_runs(ring, self.size):
+                        _add_polyline(path, ring[first:last + 1].tolist())
+            draw.path(path, aggdraw.Pen(_rgb(outline), outline_width))
+
+    def lines(self, lines, params):
+        draw = self._vector()
+        for start, stop in param_runs(params):
+            color, width = params[start]
+            path = aggdraw.Path()
+            for line in lines[start:stop]:
+                _add_polyline(path, line.tolist())
+            draw.path(path, aggdraw.Pen(_rgb(color), width))
+
+    def roads(self, lines, params):
+        draw = self._vector()
+        for start, stop in param_runs(params):
+            width, color = params[start]
+            if width <= 0:
+                continue
+            color = _rgb(color)
+            path = aggdraw.Path()
+            caps = []
+            for line in lines[start:stop]:
+                _add_polyline(path, line.tolist())
+                ends = line[[0, -1]]
+                caps.extend(ends[~border_mask(ends, self.size)].tolist())
+            draw.path(path, aggdraw.Pen(color, width))
+            brush = aggdraw.Brush(color)
+            radius = width / 2
+            for x, y in caps:
+                draw.ellipse((x - radius, y - radius, x + radius, y + radius), None, brush)
+
+    def text(self, origin, text, font, color):
+        ImageDraw.Draw(self.to_image()).text(origin, text, font=font, fill=color)
+
+    def to_image(self):
+        if self._image is None:
+            self._image = Image.frombytes("RGB", (self.size, self.size), self.draw.tobytes())
+        return self._image
+
+
+# 可选的光栅化后端
+RENDERERS = {
+    'pillow': PillowCanvas,
+    'agg': AggCanvas,
+}
+
+
+def get_renderer(name):
+    """
+    返回名为 name 的后端（画布类），未知或依赖未安装时抛出 ValueError。
+    """
+    renderer = RENDERERS.get(name)
+    if renderer is None:
+        raise ValueError(f"unknown renderer '{name}', choose from: {', '.join(sorted(RENDERERS))}")
+    if not renderer.available():
+        raise ValueError(f"the {name} renderer is not available, install aggdraw to use it")
+    return renderer
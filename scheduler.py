@@ -0,0 +1,59 @@
+from collections import Counter
+from constants import *
+from tilegrid import tile_bounds
+
+
+def subtree_counts(z, x, y, ranges):
+    """
+    返回 {缩放级别: 瓦片数}：瓦片 (z, x, y) 及其各级子瓦片中落在各级瓦片范围内的数量。
+    """
+    counts = {}
+    for child_z, (x_start, x_end, y_start, y_end) in ranges.items():
+        if child_z < z:
+            continue
+        scale = ZOOM_BASE ** (child_z - z)
+        columns = min(x_end, (x + 1) * scale - 1) - max(x_start, x * scale) + 1
+        rows = min(y_end, (y + 1) * scale - 1) - max(y_start, y * scale) + 1
+        if columns > 0 and rows > 0:
+            counts[child_z] = columns * rows
+    return counts
+
+
+def schedule_tiles(index, tile_ranges):
+    """
+    自顶向下遍历瓦片金字塔，只调度可能非空的瓦片。
+    tile_ranges: 连续缩放级别的 [(z, x_start, x_end, y_start, y_end), ...]
+    从最低级别范围内的瓦片开始，索引中没有在该级别或更高级别显示的要素时，整个子树都是空的，直接跳过；
+    否则调度该瓦片并继续检查它的四个子瓦片。
+    返回 ({z: [(x, y), ...]}, {z: Counter(scheduled=调度的瓦片数, pruned=跳过的瓦片数)})。
+    """
+    ranges = {z: (x_start, x_end, y_start, y_end) for z, x_start, x_end, y_start, y_end in tile_ranges}
+    scheduled = {z: [] for z in ranges}
+    stats = {z: Counter() for z in ranges}
+    if not ranges:
+        return scheduled, stats
+    min_zoom, max_zoom = min(ranges), max(ranges)
+    x_start, x_end, y_start, y_end = ranges[min_zoom]
+    stack = [(min_zoom, x, y) for x in range(x_start, x_end + 1) for y in range(y_start, y_end + 1)]
+    while stack:
+        z, x, y = stack.pop()
+        x_start, x_end, y_start, y_end = ranges[z]
+        if not (x_start <= x <= x_end and y_start <= y <= y_end):
+            continue
+        if not index.has_features(z, tile_bounds(z, x, y)):
+            for child_z, count in subtree_counts(z, x, y, ranges).items():
+                stats[child_z]['pruned'] += count
+            continue
+        scheduled[z].append((x, y))
+        stats[z]['scheduled'] += 1
+        if z < max_zoom:
+            stack.extend((z + 1, 2 * x + dx, 2 * y + dy) for dx in (0, 1) for dy in (0, 1))
+    for tiles in scheduled.values():
+        tiles.sort()
+    return scheduled, stats
+
+
+def print_schedule_report(stats):
+    for z in sorted(stats):
+        counts = stats[z]
+        print(f"Zoom {z}: {counts['scheduled']} tiles scheduled, {counts['pruned']} skipped in empty subtrees")
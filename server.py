@@ -0,0 +1,288 @@
+import argparse
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from constants import *
+from drawer import TileDrawer
+from feature_index import FeatureIndex
+from feature_store import FeatureStore
+from labels import load_font
+from raster import RENDERERS, get_renderer
+from style import DEFAULT_STYLE, load_style
+from tile_encoder import TileEncoder, add_encoder_arguments, encoder_from_args
+
+TILE_PATH = re.compile(r'^/(\d+)/(\d+)/(\d+)\.(\w+)$')
+
+
+class TileCache:
+    """
+    按字节数限制大小的内存 LRU 缓存，后面可选地接一层磁盘缓存。
+    空瓦片以 b'' 缓存，磁盘上对应一个空文件。
+    """
+
+    def __init__(self, max_bytes, cache_dir=None, extension='png'):
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self.extension = extension
+        self.size = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def _disk_path(self, z, x, y):
+        return os.path.join(self.cache_dir, str(z), str(x), f"{y}.{self.extension}")
+
+    def get_memory(self, key):
+        with self.lock:
+            data = self.entries.get(key)
+            if data is not None:
+                self.entries.move_to_end(key)
+            return data
+
+    def get_disk(self, key):
+        if self.cache_dir is None:
+            return None
+        try:
+            with open(self._disk_path(*key), 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        self.put_memory(key, data)
+        return data
+
+    def put_memory(self, key, data):
+        with self.lock:
+            if key in self.entries:
+                self.size -= len(self.entries.pop(key))
+            self.entries[key] = data
+            self.size += len(data)
+            while self.size > self.max_bytes and self.entries:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+
+    def put(self, key, data):
+        self.put_memory(key, data)
+        if self.cache_dir is not None:
+            path = self._disk_path(*key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # 先写临时文件再改名，避免并发读到写了一半的文件
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+
+
+class TileMetrics:
+    """
+    请求数、缓存命中率和渲染耗时统计。
+    """
+
+    def __init__(self, window=1000):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.renders = 0
+        self.collapsed = 0
+        self.errors = 0
+        self.latencies = deque(maxlen=window)
+
+    def count(self, name):
+        with self.lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def record_render(self, seconds):
+        with self.lock:
+            self.renders += 1
+            self.latencies.append(seconds)
+
+    def snapshot(self):
+        with self.lock:
+            latencies = sorted(self.latencies)
+            hits = self.memory_hits + self.disk_hits
+
+            def percentile(p):
+                return latencies[min(len(latencies) - 1, int(p * len(latencies)))] * 1000 if latencies else None
+
+            return {
+                'requests': self.requests,
+                'memory_hits': self.memory_hits,
+                'disk_hits': self.disk_hits,
+                'renders': self.renders,
+                'collapsed_requests': self.collapsed,
+                'errors': self.errors,
+                'hit_rate': hits / self.requests if self.requests else None,
+                'render_ms': {
+                    'mean': sum(latencies) / len(latencies) * 1000 if latencies else None,
+                    'p50': percentile(0.50),
+                    'p95': percentile(0.95),
+                    'max': latencies[-1] * 1000 if latencies else None,
+                },
+            }
+
+
+class TileService:
+    """
+    按需渲染瓦片：先查内存缓存和磁盘缓存，未命中时渲染；
+    同一瓦片的并发请求合并为一次渲染。
+    """
+
+    def __init__(self, index, font_path, cache, min_zoom=1, max_zoom=18, encoder=None, style=None, renderer=None):
+        self.index = index
+        self.font_path = font_path
+        self.style = style or load_style()
+        self.renderer = renderer
+        self.cache = cache
+        self.encoder = encoder or TileEncoder()
+        self.min_zoom = min_zoom
+        self.max_zoom = max_zoom
+        self.metrics = TileMetrics()
+        self.inflight = {}
+        self.inflight_lock = threading.Lock()
+        self._local = threading.local()
+
+    def font(self):
+        # 字体对象不在线程间共享
+        if getattr(self._local, 'font', None) is None:
+            self._local.font = load_font(self.font_path)
+        return self._local.font
+
+    def render(self, z, x, y):
+        start = time.perf_counter()
+        img = TileDrawer(z, x, y, self.index, self.font(), style=self.style, renderer=self.renderer).result
+        # 纯色瓦片由编码器按颜色只编码一次，各瓦片共用同一份数据
+        data = b'' if img is None else self.encoder.encode(img)
+        self.metrics.record_render(time.perf_counter() - start)
+        return data
+
+    def get(self, z, x, y):
+        """
+        返回瓦片的 PNG 数据，空瓦片返回 b''。
+        """
+        key = (z, x, y)
+        self.metrics.count('requests')
+        data = self.cache.get_memory(key)
+        if data is not None:
+            self.metrics.count('memory_hits')
+            return data
+        data = self.cache.get_disk(key)
+        if data is not None:
+            self.metrics.count('disk_hits')
+            return data
+
+        with self.inflight_lock:
+            future = self.inflight.get(key)
+            owner = future is None
+            if owner:
+                future = self.inflight[key] = Future()
+        if not owner:
+            self.metrics.count('collapsed')
+            return future.result()
+
+        try:
+            data = self.render(z, x, y)
+            self.cache.put(key, data)
+            future.set_result(data)
+        except Exception as e:
+            self.metrics.count('errors')
+            future.set_exception(e)
+            raise
+        finally:
+            with self.inflight_lock:
+                del self.inflight[key]
+        return data
+
+
+class TileRequestHandler(BaseHTTPRequestHandler):
+    service = None
+
+    def do_GET(self):
+        if self.path == '/metrics':
+            self.send_body(200, 'application/json', json.dumps(self.service.metrics.snapshot()).encode())
+            return
+        match = TILE_PATH.match(self.path)
+        if match is None:
+            self.send_error(404)
+            return
+        z, x, y = map(int, match.groups()[:3])
+        if match.group(4) != self.service.encoder.extension:
+            self.send_error(404)
+            return
+        if not (self.service.min_zoom <= z <= self.service.max_zoom and 0 <= x < 2 ** z and 0 <= y < 2 ** z):
+            self.send_error(404)
+            return
+        try:
+            data = self.service.get(z, x, y)
+        except Exception as e:
+            self.send_error(500, explain=repr(e))
+            return
+        if not data:
+            self.send_error(404)
+            return
+        self.send_body(200, self.service.encoder.mime_type, data)
+
+    def send_body(self, status, content_type, body):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def load_index(args, style):
+    if args.store:
+        index = FeatureStore(args.store, readonly=True)
+        print(f"Opened feature store '{args.store}' with {len(index)} features.")
+        return index
+    from main import OSMHandler
+    index = FeatureIndex()
+    handler = OSMHandler(index, args.font, style=style)
+    handler.apply_file(args.osm_file, locations=True, idx=args.node_index)
+    print(f"Loaded {len(index)} features from '{args.osm_file}'.")
+    return index
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve /{z}/{x}/{y}.png tiles rendered on demand.")
+    parser.add_argument('osm_file', nargs='?', default='map.osm',
+                        help="input OSM file, used when --store is not given (default: map.osm)")
+    parser.add_argument('--store', help="serve from an existing SQLite feature store built by main.py")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--font', default=FONT_PATH, help="font used for labels")
+    parser.add_argument('--style', default=DEFAULT_STYLE,
+                        help="style file; must match the one the feature store was built with (default: style.json)")
+    parser.add_argument('--renderer', choices=sorted(RENDERERS), default='pillow',
+                        help="rasterization backend; agg needs aggdraw (default: pillow)")
+    parser.add_argument('--node-index', default='sparse_mem_array', help="osmium node location index")
+    parser.add_argument('--cache-dir', help="directory for the on-disk tile cache")
+    parser.add_argument('--cache-mb', type=float, default=256, help="in-memory tile cache size in MB (default: 256)")
+    parser.add_argument('--min-zoom', type=int, default=1)
+    parser.add_argument('--max-zoom', type=int, default=18)
+    add_encoder_arguments(parser)
+    args = parser.parse_args()
+    encoder = encoder_from_args(args)
+    try:
+        style = load_style(args.style)
+        renderer = get_renderer(args.renderer)
+    except (OSError, ValueError) as e:
+        parser.error(str(e))
+
+    index = load_index(args, style)
+    cache = TileCache(int(args.cache_mb * 1024 * 1024), args.cache_dir, encoder.extension)
+    TileRequestHandler.service = TileService(index, args.font, cache, args.min_zoom, args.max_zoom, encoder, style,
+                                             renderer)
+    server = ThreadingHTTPServer((args.host, args.port), TileRequestHandler)
+    print(f"Serving tiles on http://{args.host}:{args.port}/{{z}}/{{x}}/{{y}}.{encoder.extension}, metrics on /metrics")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,254 @@
+import json
+import os
+from constants import *
+
+# 默认样式文件
+DEFAULT_STYLE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'style.json')
+
+# 编译绘制计划的缩放级别
+ZOOMS = range(1, 19)
+
+GEOMETRIES = ('line', 'polygon')
+DRAW_TYPES = ('polygon', 'fill', 'line', 'road', 'text')
+
+
+def _color(value):
+    # JSON 中颜色为 [r, g, b] 或 Pillow 认识的颜色名
+    return tuple(value) if isinstance(value, list) else value
+
+
+def _compile_draw(draw, z, where):
+    # 绘制参数缺失或类型不对时，以 ValueError 指出出错的图层
+    try:
+        return _draw_params(draw, z)
+    except KeyError as e:
+        raise ValueError(f"{where}: draw needs '{e.args[0]}'") from None
+    except (TypeError, ValueError) as e:
+        raise ValueError(f"{where}: invalid draw parameters: {e}") from None
+
+
+def _zoom(value, where):
+    if value is None or len(value) != 2 or value[0] > value[1]:
+        raise ValueError(f"{where}: zoom must be [min_zoom, max_zoom]")
+    return int(value[0]), int(value[1])
+
+
+class Rule:
+    """
+    样式文件中的一个图层：入库时的匹配规则（标签、细分类型、缩放级别范围、名称标签）和绘制参数。
+
+    match 为 {标签: "*" 或 [取值, ...]}，任一标签匹配即可；kind 为细分类型取自的标签列表，
+    取第一个非空的值，replace 把某个细分类型替换为另一个标签的值（如 highway=construction）。
+    有 kinds 时只接受其中列出的细分类型，各类型可覆盖 zoom 和绘制参数。
+    """
+
+    def __init__(self, spec):
+        self.layer = spec['layer']
+        self.geometry = spec.get('geometry', 'polygon')
+        if self.geometry not in GEOMETRIES:
+            raise ValueError(f"layer '{self.layer}': unknown geometry '{self.geometry}'")
+        self.draw = dict(spec['draw'])
+        if self.draw.get('type') not in DRAW_TYPES:
+            raise ValueError(f"layer '{self.layer}': unknown draw type '{self.draw.get('type')}'")
+        self.relations = spec.get('relations', False)
+        self.match = {key: None if values == '*' else frozenset(values)
+                      for key, values in spec.get('match', {}).items()}
+        self.kind_tags = spec.get('kind', [])
+        self.replace = spec.get('replace', {})
+        zoom = spec.get('zoom')
+        self.zoom = _zoom(zoom, f"layer '{self.layer}'") if zoom is not None else None
+        self.kinds = {}
+        self.zooms = {}
+        for kind, props in spec.get('kinds', {}).items():
+            props = dict(props)
+            self.zooms[kind] = _zoom(props.pop('zoom', zoom), f"layer '{self.layer}', kind '{kind}'")
+            self.kinds[kind] = dict(self.draw, **props)
+        label = spec.get('label')
+        # 名称标签：(标签键, 最小缩放级别, 最大缩放级别)，写入 text 图层
+        self.label = None if label is None else (label['tag'],) + _zoom(label.get('zoom'), f"layer '{self.layer}' label")
+        # 能构成要素所需的最少节点数
+        self.min_points = 2 if self.geometry == 'line' else 3
+
+    @property
+    def ingested(self):
+        return bool(self.match or self.kind_tags)
+
+    def classify(self, tags):
+        """
+        按标签匹配要素，返回 (细分类型, 最小缩放级别, 最大缩放级别)，不匹配时返回 None。
+        """
+        if self.match:
+            for key, values in self.match.items():
+                value = tags.get(key)
+                if value is not None and (values is None or value in values):
+                    break
+            else:
+                return None
+        if not self.kind_tags:
+            return (None,) + self.zoom
+        kind = None
+        for key in self.kind_tags:
+            kind = tags.get(key)
+            if kind:
+                break
+        if not kind:
+            return None
+        if kind in self.replace:
+            kind = tags.get(self.replace[kind]) or kind
+        zoom = self.zooms.get(kind) if self.zooms else self.zoom
+        if zoom is None:
+            return None
+        return (kind,) + zoom
+
+    def zoom_range(self):
+        """
+        该图层的要素可能出现的缩放级别范围，没有要素入库时返回 None。
+        """
+        zooms = list(self.zooms.values()) or ([self.zoom] if self.zoom else [])
+        if not zooms:
+            return None
+        return min(zoom[0] for zoom in zooms), max(zoom[1] for zoom in zooms)
+
+
+class LayerPlan:
+    """
+    某一缩放级别下一个图层的绘制计划：绘制方式，以及按细分类型解析好的颜色和像素线宽。
+    各绘制方式的参数元组：
+      polygon: (填充色, 轮廓色, 轮廓宽度)
+      fill:    (填充色,)
+      line:    (颜色, 线宽)
+      road:    (外框线宽, 外框颜色, 内线宽, 内线颜色)，道路较窄时内线宽为 None，只画一遍
+      text:    (颜色,)
+    """
+    __slots__ = ('layer', 'type', 'geometry', 'stage', 'default', 'kinds')
+
+    def __init__(self, layer, draw_type, geometry, default, kinds):
+        self.layer = layer
+        self.type = draw_type
+        self.geometry = geometry
+        self.stage = 'render.draw.' + layer
+        self.default = default
+        self.kinds = kinds
+
+    def resolve(self, kind_names):
+        """
+        按图层的细分类型表返回各编码对应的参数元组，绘制时按编码取用，不必逐个要素查表。
+        样式中没有的细分类型（例如用其他样式建立的要素库）使用图层的默认参数。
+        """
+        return [self.kinds.get(name, self.default) for name in kind_names]
+
+
+def _draw_params(draw, z):
+    """
+    把绘制参数解析为缩放级别 z 下的参数元组（见 LayerPlan）。
+    设置了 width_zoom 的线宽是该级别下的像素宽度，每低一级减半。
+    """
+    draw_type = draw['type']
+    if draw_type == 'polygon':
+        return _color(draw['fill']), _color(draw['outline']), draw.get('outline_width', 1)
+    if draw_type == 'fill':
+        return (_color(draw['fill']),)
+    if draw_type in ('line', 'road'):
+        width = draw['width']
+        if draw.get('width_zoom') is not None:
+            width = width / ZOOM_BASE ** (draw['width_zoom'] - z)
+    if draw_type == 'line':
+        return _color(draw['color']), int(width)
+    if draw_type == 'road':
+        casing = draw.get('casing', 0)
+        if width <= casing:
+            return width, _color(draw['color']), None, None
+        return width, _color(draw['outline']), width - casing, _color(draw['color'])
+    return (_color(draw.get('color', 'black')),)
+
+
+class ZoomPlan:
+    """
+    某一缩放级别的绘制计划：按绘制顺序排列的 LayerPlan，只包含该级别下可能有要素的图层。
+    """
+
+    def __init__(self, z, background, layers):
+        self.z = z
+        self.background = background
+        self.layers = layers
+        self.layer_names = [plan.layer for plan in layers]
+
+
+class Style:
+    """
+    编译后的样式。入库时由 classify 按各图层的规则给要素分类，
+    渲染时由 plan(z) 取得该缩放级别的绘制计划；两者来自同一份规则。
+    各缩放级别的绘制计划在加载时一次编译好，样式文件中的错误在开始渲染前就会报出。
+    """
+
+    def __init__(self, spec, path=None):
+        self.path = path
+        self.background = _color(spec.get('background', [255, 255, 255]))
+        self.rules = [Rule(layer) for layer in spec['layers']]
+        names = [rule.layer for rule in self.rules]
+        if len(set(names)) != len(names):
+            raise ValueError("each layer may appear only once in a style")
+        self.way_rules = [rule for rule in self.rules if rule.ingested]
+        self.relation_rules = [rule for rule in self.way_rules if rule.relations]
+        self.label_rules = [rule for rule in self.rules if rule.label is not None]
+        if self.label_rules and 'text' not in names:
+            raise ValueError("labels need a 'text' layer in the style")
+        self._plans = {z: self._compile(z) for z in ZOOMS}
+
+    def classify(self, tags, relations=False):
+        """
+        返回与标签匹配的 [(规则, 细分类型, 最小缩放级别, 最大缩放级别), ...]。
+        relations 为 True 时只使用适用于多边形关系的规则。
+        """
+        matches = []
+        for rule in self.relation_rules if relations else self.way_rules:
+            match = rule.classify(tags)
+            if match is not None:
+                matches.append((rule,) + match)
+        return matches
+
+    def _visible(self, rule, z):
+        if rule.layer == 'text':
+            return any(label_rule.label[1] <= z <= label_rule.label[2] for label_rule in self.label_rules)
+        zoom = rule.zoom_range()
+        return zoom is not None and zoom[0] <= z <= zoom[1]
+
+    def _compile(self, z):
+        layers = []
+        for rule in self.rules:
+            if not self._visible(rule, z):
+                continue
+            where = f"layer '{rule.layer}'"
+            kinds = {kind: _compile_draw(draw, z, f"{where}, kind '{kind}'") for kind, draw in rule.kinds.items()}
+            layers.append(LayerPlan(rule.layer, rule.draw['type'], rule.geometry, _compile_draw(rule.draw, z, where),
+                                    kinds))
+        return ZoomPlan(z, self.background, layers)
+
+    def plan(self, z):
+        """
+        返回缩放级别 z 的绘制计划。
+        """
+        return self._plans[z]
+
+
+# 已加载的样式，按路径缓存
+_styles = {}
+
+
+def load_style(path=DEFAULT_STYLE):
+    """
+    加载并编译样式文件，同一路径只加载一次。样式文件有误时抛出 ValueError。
+    """
+    path = os.path.abspath(path)
+    style = _styles.get(path)
+    if style is None:
+        with open(path, encoding='utf-8') as f:
+            try:
+                spec = json.load(f)
+            except json.JSONDecodeError as e:
+                raise ValueError(f"style '{path}' is not valid JSON: {e}") from None
+        try:
+            style = _styles[path] = Style(spec, path)
+        except (KeyError, TypeError) as e:
+            raise ValueError(f"style '{path}' is invalid: {e!r}") from None
+    return style
@@ -0,0 +1,167 @@
+import argparse
+import glob
+import io
+import os
+import time
+import zlib
+import numpy as np
+from PIL import Image
+
+# PNG 的 zlib 压缩策略，对应 Pillow 的 compress_type 参数
+PNG_STRATEGIES = {
+    'default': zlib.Z_DEFAULT_STRATEGY,
+    'filtered': zlib.Z_FILTERED,
+    'huffman': zlib.Z_HUFFMAN_ONLY,
+    'rle': zlib.Z_RLE,
+    'fixed': zlib.Z_FIXED,
+}
+
+# 各格式的文件扩展名、MIME 类型和 PMTiles 瓦片类型编号
+FORMATS = {
+    'png': ('png', 'image/png', 2),
+    'webp': ('webp', 'image/webp', 4),
+}
+
+
+def solid_color(img):
+    """
+    纯色图像返回其颜色，否则返回 None。getcolors 遇到第二种颜色就会停止，对普通瓦片几乎没有开销。
+    """
+    colors = img.getcolors(1)
+    return colors[0][1] if colors else None
+
+
+def to_palette(img):
+    """
+    颜色不超过 256 种时无损转换为 8 位调色板图像，否则返回 None。
+
+    渲染用到的颜色都来自样式文件（默认 style.json，可用 --style 指定），再加上文字抗锯齿产生的少量过渡色，
+    所以 pillow 后端渲染出的瓦片几乎都能无损转换；agg 后端的抗锯齿边缘和缩小生成的概览瓦片颜色较多，
+    超过 256 种时保持 RGB。
+    Pillow 的 RGB→P 转换按 6 位精度查找最近颜色，相近的抗锯齿颜色会被合并，这里用精确映射。
+    """
+    colors = img.getcolors(256)
+    if colors is None:
+        return None
+    palette = np.array([color for _, color in colors], dtype=np.uint8)
+    # RGBX 的填充字节为 255
+    palette_keys = np.frombuffer(np.pad(palette, ((0, 0), (0, 1)), constant_values=255).tobytes(), dtype=np.uint32)
+    keys = np.frombuffer(img.convert('RGBX').tobytes(), dtype=np.uint32)
+    # 用乘法散列把颜色映射到 64K 的查找表，调整乘数直到调色板内没有冲突
+    multiplier = np.uint32(2654435761)
+    while True:
+        slots = (palette_keys * multiplier) >> np.uint32(16)
+        if len(np.unique(slots)) == len(slots):
+            break
+        multiplier += np.uint32(2)
+    table = np.zeros(1 << 16, dtype=np.uint8)
+    table[slots] = np.arange(len(slots))
+    indices = table[(keys * multiplier) >> np.uint32(16)]
+    out = Image.frombuffer('P', img.size, indices.tobytes(), 'raw', 'P', 0, 1)
+    out.putpalette(palette.tobytes())
+    return out
+
+
+class TileEncoder:
+    """
+    瓦片编码设置：PNG（可选 8 位调色板、zlib 压缩级别和策略）或 WebP（无损或有损）。
+    纯色瓦片每种颜色只编码一次。
+    """
+
+    def __init__(self, fmt='png', palette=False, compress_level=6, strategy='default', quality=None):
+        self.format = fmt
+        self.extension, self.mime_type, self.pmtiles_type = FORMATS[fmt]
+        self.palette = palette
+        self.compress_level = compress_level
+        self.strategy = strategy
+        self.quality = quality
+        self._solid = {}
+
+    def encode(self, img):
+        color = solid_color(img)
+        if color is not None and color in self._solid:
+            return self._solid[color]
+        buf = io.BytesIO()
+        if self.format == 'webp':
+            if self.quality is None:
+                img.save(buf, format='WEBP', lossless=True)
+            else:
+                img.save(buf, format='WEBP', quality=self.quality)
+        else:
+            if self.palette:
+                img = to_palette(img) or img
+            img.save(buf, format='PNG', compress_level=self.compress_level,
+                     compress_type=PNG_STRATEGIES[self.strategy])
+        data = buf.getvalue()
+        if color is not None:
+            self._solid[color] = data
+        return data
+
+    def describe(self):
+        if self.format == 'webp':
+            return 'webp lossless' if self.quality is None else f'webp q{self.quality}'
+        return (f"png{' palette' if self.palette else ''} level {self.compress_level}"
+                f"{'' if self.strategy == 'default' else ' ' + self.strategy}")
+
+
+def add_encoder_arguments(parser):
+    parser.add_argument('--tile-format', choices=sorted(FORMATS), default='png', help="tile image format (default: png)")
+    parser.add_argument('--palette', action='store_true',
+                        help="write 8-bit palette PNGs when a tile has at most 256 colours (lossless)")
+    parser.add_argument('--compress-level', type=int, choices=range(10), default=6, metavar='0-9',
+                        help="PNG zlib compression level (default: 6)")
+    parser.add_argument('--png-strategy', choices=sorted(PNG_STRATEGIES), default='default',
+                        help="PNG zlib strategy (default: default)")
+    parser.add_argument('--webp-quality', type=int, metavar='Q',
+                        help="lossy WebP quality 0-100; WebP is lossless when omitted")
+
+
+def encoder_from_args(args):
+    return TileEncoder(args.tile_format, args.palette, args.compress_level, args.png_strategy, args.webp_quality)
+
+
+# 基准测试比较的编码设置
+BENCHMARK_ENCODERS = [
+    TileEncoder('png'),
+    TileEncoder('png', compress_level=1),
+    TileEncoder('png', compress_level=9),
+    TileEncoder('png', compress_level=6, strategy='rle'),
+    TileEncoder('png', palette=True, compress_level=1),
+    TileEncoder('png', palette=True),
+    TileEncoder('png', palette=True, compress_level=9),
+    TileEncoder('png', palette=True, compress_level=6, strategy='rle'),
+    TileEncoder('webp'),
+    TileEncoder('webp', quality=80),
+]
+
+
+def benchmark(images, encoders=BENCHMARK_ENCODERS):
+    """
+    用各编码设置编码同一批瓦片，打印每个瓦片的平均编码耗时和字节数。
+    """
+    for encoder in encoders:
+        # 纯色瓦片的缓存会掩盖编码耗时，每轮都从空缓存开始
+        encoder._solid = {}
+        start = time.perf_counter()
+        size = sum(len(encoder.encode(img)) for img in images)
+        elapsed = time.perf_counter() - start
+        print(f"{encoder.describe():<32} {elapsed / len(images) * 1000:7.2f} ms/tile "
+              f"{size / len(images) / 1024:8.2f} KB/tile {size / 1024 / 1024:8.2f} MB total")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare tile encoding settings on rendered tiles.")
+    parser.add_argument('tile_dir', nargs='?', default='tile', help="z/x/y.png directory written by main.py")
+    parser.add_argument('--limit', type=int, default=500, help="number of tiles to sample (default: 500)")
+    args = parser.parse_args()
+
+    paths = sorted(glob.glob(os.path.join(args.tile_dir, '*', '*', '*.png')))
+    paths = paths[::max(1, len(paths) // args.limit)][:args.limit]
+    if not paths:
+        parser.error(f"no tiles found in '{args.tile_dir}'")
+    images = []
+    for path in paths:
+        with Image.open(path) as img:
+            images.append(img.convert('RGB'))
+    print(f"Encoding {len(images)} tiles from '{args.tile_dir}':")
+    benchmark(images)
@@ -0,0 +1,416 @@
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import struct
+from collections import Counter
+from PIL import Image
+from constants import *
+from projection import MAX_LATITUDE
+from profiling import timed
+from tile_encoder import TileEncoder, solid_color
+
+# 目录输出中纯色瓦片按颜色只保存一份，放在输出目录的这个子目录下
+SHARED_DIR = 'shared'
+
+def count_tile(stats, z, shared_bytes=0):
+    """
+    在 stats[z] 中累计保存的瓦片数；shared_bytes > 0 表示该瓦片引用了已有的数据，计入节省的字节数。
+    """
+    zoom_stats = stats.setdefault(z, Counter())
+    zoom_stats['saved'] += 1
+    if shared_bytes:
+        zoom_stats['shared'] += 1
+        zoom_stats['bytes_saved'] += shared_bytes
+
+
+def encode_tile(encoder, z, img, stats):
+    """
+    编码瓦片图像，耗时计入 stats[z] 的 write.encode 阶段。
+    """
+    with timed(stats.setdefault(z, Counter()), 'write.encode'):
+        return encoder.encode(img)
+
+
+class DirectorySink:
+    """
+    z/x/y.png（或 .webp）目录输出，供 Leaflet 等直接按路径加载瓦片的前端使用。
+    纯色瓦片硬链接到 shared/ 下的同一个文件；各工作进程可以直接写入。
+    """
+
+    concurrent = True
+
+    def __init__(self, path, encoder=None):
+        self.path = path
+        self.encoder = encoder or TileEncoder()
+
+    def tile_file(self, z, x, y):
+        return os.path.join(self.path, str(z), str(x), f"{y}.{self.encoder.extension}")
+
+    def shared_tile(self, color):
+        """
+        返回颜色为 color 的共享纯色瓦片路径，不存在时先生成。
+        """
+        path = os.path.join(self.path, SHARED_DIR, '%02x%02x%02x.' % color + self.encoder.extension)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # 多个工作进程可能同时生成同一个文件，先写临时文件再改名
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(self.encoder.encode(Image.new("RGB", (TILE_SIZE, TILE_SIZE), color)))
+            os.replace(tmp_path, path)
+        return path
+
+    def _prepare(self, z, x, y):
+        tile_file = self.tile_file(z, x, y)
+        os.makedirs(os.path.dirname(tile_file), exist_ok=True)
+        # 旧文件可能是共享瓦片的硬链接，必须先删除，不能原地覆盖
+        if os.path.lexists(tile_file):
+            os.remove(tile_file)
+        return tile_file
+
+    def write(self, z, x, y, img, stats):
+        color = solid_color(img)
+        if color is None:
+            self.write_data(z, x, y, encode_tile(self.encoder, z, img, stats), stats)
+            return
+        tile_file = self._prepare(z, x, y)
+        blob = self.shared_tile(color)
+        try:
+            os.link(blob, tile_file)
+        except OSError:
+            # 文件系统不支持硬链接时退回复制
+            shutil.copyfile(blob, tile_file)
+            count_tile(stats, z)
+            return
+        count_tile(stats, z, os.path.getsize(blob))
+
+    def write_data(self, z, x, y, data, stats):
+        with open(self._prepare(z, x, y), 'wb') as f:
+            f.write(data)
+        count_tile(stats, z)
+
+    def delete(self, z, x, y):
+        tile_file = self.tile_file(z, x, y)
+        if os.path.lexists(tile_file):
+            os.remove(tile_file)
+
+    def read(self, z, x, y):
+        try:
+            with open(self.tile_file(z, x, y), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def close(self):
+        pass
+
+
+MBTILES_SCHEMA = """
+CREATE TABLE map (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_id TEXT);
+CREATE UNIQUE INDEX map_index ON map (zoom_level, tile_column, tile_row);
+CREATE TABLE images (tile_id TEXT, tile_data BLOB);
+CREATE UNIQUE INDEX images_id ON images (tile_id);
+CREATE TABLE metadata (name TEXT, value TEXT);
+CREATE UNIQUE INDEX name ON metadata (name);
+CREATE VIEW tiles AS
+    SELECT map.zoom_level AS zoom_level, map.tile_column AS tile_column, map.tile_row AS tile_row,
+           images.tile_data AS tile_data
+    FROM map JOIN images ON images.tile_id = map.tile_id;
+"""
+
+
+class MBTilesSink:
+    """
+    MBTiles（SQLite）输出。瓦片数据按内容哈希去重保存在 images 表中，map 表只保存引用；
+    写入按 batch_size 分批提交。SQLite 不适合多进程并发写入，并行渲染时由父进程统一写入。
+    update 为 True 时在已有文件上增量更新，否则重新创建。
+    """
+
+    concurrent = False
+
+    def __init__(self, path, bounds=None, min_zoom=None, max_zoom=None, encoder=None, update=False,
+                 batch_size=1000):
+        self.path = path
+        self.encoder = encoder or TileEncoder()
+        self.update = update
+        self.batch_size = batch_size
+        if os.path.exists(path) and not update:
+            os.remove(path)
+        self.conn = sqlite3.connect(path)
+        # 输出文件可以随时重新生成，写入时不需要同步刷盘
+        self.conn.execute("PRAGMA synchronous = OFF")
+        if not update:
+            self.conn.executescript(MBTILES_SCHEMA)
+        self.metadata = {'name': os.path.splitext(os.path.basename(path))[0], 'format': self.encoder.format,
+                         'type': 'baselayer'}
+        if bounds is not None:
+            self.metadata['bounds'] = ','.join(str(v) for v in bounds)
+        if min_zoom is not None:
+            self.metadata['minzoom'] = str(min_zoom)
+            self.metadata['maxzoom'] = str(max_zoom)
+        # 本次写入的内容哈希；增量更新时已有的数据由 INSERT OR IGNORE 去重
+        self.tile_ids = set()
+        self._map = []
+        self._images = []
+        # 尚未提交的瓦片，生成概览瓦片时可能马上要读回
+        self._pending = {}
+
+    def write(self, z, x, y, img, stats):
+        self.write_data(z, x, y, encode_tile(self.encoder, z, img, stats), stats)
+
+    def write_data(self, z, x, y, data, stats):
+        tile_id = hashlib.md5(data).hexdigest()
+        if tile_id in self.tile_ids:
+            count_tile(stats, z, len(data))
+        else:
+            self.tile_ids.add(tile_id)
+            self._images.append((tile_id, data))
+            count_tile(stats, z)
+        # MBTiles 的行号采用 TMS 方向（自下而上）
+        self._map.append((z, x, (1 << z) - 1 - y, tile_id))
+        self._pending[(z, x, y)] = data
+        if len(self._map) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self._map:
+            return
+        with self.conn:
+            self.conn.executemany("INSERT OR IGNORE INTO images VALUES (?, ?)", self._images)
+            self.conn.executemany("INSERT OR REPLACE INTO map VALUES (?, ?, ?, ?)", self._map)
+        self._map = []
+        self._images = []
+        self._pending = {}
+
+    def delete(self, z, x, y):
+        self.flush()
+        with self.conn:
+            self.conn.execute("DELETE FROM map WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?",
+                              (z, x, (1 << z) - 1 - y))
+
+    def read(self, z, x, y):
+        if (z, x, y) in self._pending:
+            return self._pending[(z, x, y)]
+        row = self.conn.execute(
+            "SELECT tile_data FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?",
+            (z, x, (1 << z) - 1 - y)).fetchone()
+        return row[0] if row else None
+
+    def close(self):
+        self.flush()
+        with self.conn:
+            if self.update:
+                # 被替换或删除的瓦片留下的数据不再被引用
+                self.conn.execute("DELETE FROM images WHERE tile_id NOT IN (SELECT tile_id FROM map)")
+            self.conn.executemany("INSERT OR REPLACE INTO metadata VALUES (?, ?)", self.metadata.items())
+        self.conn.close()
+
+
+def zxy_to_tileid(z, x, y):
+    """
+    PMTiles 的瓦片编号：低缩放级别的瓦片总数加上该级别内的 Hilbert 曲线序号。
+    """
+    acc = ((1 << (2 * z)) - 1) // 3
+    n = 1 << z
+    d = 0
+    s = n // 2
+    while s > 0:
+        rx = 1 if x & s else 0
+        ry = 1 if y & s else 0
+        d += s * s * ((3 * rx) ^ ry)
+        if ry == 0:
+            if rx == 1:
+                x = n - 1 - x
+                y = n - 1 - y
+            x, y = y, x
+        s >>= 1
+    return acc + d
+
+
+def write_varint(out, value):
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def serialize_directory(entries):
+    """
+    按 PMTiles v3 格式序列化目录，entries 为按 tile_id 排序的 (tile_id, offset, length, run_length)。
+    """
+    out = bytearray()
+    write_varint(out, len(entries))
+    last_id = 0
+    for tile_id, _, _, _ in entries:
+        write_varint(out, tile_id - last_id)
+        last_id = tile_id
+    for _, _, _, run_length in entries:
+        write_varint(out, run_length)
+    for _, _, length, _ in entries:
+        write_varint(out, length)
+    for i, (_, offset, _, _) in enumerate(entries):
+        # 与上一条目的数据首尾相接时写 0，否则写 offset + 1
+        if i > 0 and offset == entries[i - 1][1] + entries[i - 1][2]:
+            write_varint(out, 0)
+        else:
+            write_varint(out, offset + 1)
+    return gzip.compress(bytes(out), mtime=0)
+
+
+# 文件头加根目录必须位于文件的前 16 KB 内
+PMTILES_HEADER_SIZE = 127
+PMTILES_ROOT_LIMIT = 16384 - PMTILES_HEADER_SIZE
+
+
+def build_directories(entries):
+    """
+    返回 (根目录, 叶目录)。条目太多、根目录放不下时，把条目分组写入叶目录，
+    根目录只保存指向各叶目录的条目（run_length 为 0）。
+    """
+    root = serialize_directory(entries)
+    if len(root) <= PMTILES_ROOT_LIMIT:
+        return root, b''
+    leaf_size = 4096
+    while True:
+        leaves = bytearray()
+        root_entries = []
+        for i in range(0, len(entries), leaf_size):
+            leaf = serialize_directory(entries[i:i + leaf_size])
+            root_entries.append((entries[i][0], len(leaves), len(leaf), 0))
+            leaves += leaf
+        root = serialize_directory(root_entries)
+        if len(root) <= PMTILES_ROOT_LIMIT:
+            return root, bytes(leaves)
+        leaf_size *= 2
+
+
+class PMTilesSink:
+    """
+    PMTiles v3 单文件输出。瓦片数据先按写入顺序追加到临时文件（相同内容只写一次），
+    close() 时生成目录并写出 文件头 + 根目录 + 元数据 + 叶目录 + 瓦片数据。
+    与 MBTilesSink 一样由父进程统一写入。PMTiles 文件只能整体写出，不支持增量更新。
+    """
+
+    concurrent = False
+
+    def __init__(self, path, bounds=None, min_zoom=None, max_zoom=None, encoder=None, update=False):
+        if update:
+            raise ValueError("PMTiles archives can't be updated in place; write MBTiles or a directory instead")
+        self.path = path
+        self.encoder = encoder or TileEncoder()
+        self.bounds = bounds or (-180.0, -MAX_LATITUDE, 180.0, MAX_LATITUDE)
+        self.min_zoom = min_zoom
+        self.max_zoom = max_zoom
+        self.data_path = f"{path}.data.tmp"
+        self.data = open(self.data_path, 'w+b')
+        self.data_size = 0
+        self.entries = {}  # tile_id -> (offset, length)
+        self.contents = {}  # 内容哈希 -> (offset, length)
+
+    def write(self, z, x, y, img, stats):
+        self.write_data(z, x, y, encode_tile(self.encoder, z, img, stats), stats)
+
+    def write_data(self, z, x, y, data, stats):
+        digest = hashlib.md5(data).digest()
+        location = self.contents.get(digest)
+        if location is None:
+            location = self.contents[digest] = (self.data_size, len(data))
+            self.data.seek(self.data_size)
+            self.data.write(data)
+            self.data_size += len(data)
+            count_tile(stats, z)
+        else:
+            count_tile(stats, z, len(data))
+        self.entries[zxy_to_tileid(z, x, y)] = location
+
+    def read(self, z, x, y):
+        location = self.entries.get(zxy_to_tileid(z, x, y))
+        if location is None:
+            return None
+        offset, length = location
+        self.data.seek(offset)
+        return self.data.read(length)
+
+    def close(self):
+        # 相邻编号且指向同一数据的瓦片合并为一个条目
+        entries = []
+        for tile_id in sorted(self.entries):
+            offset, length = self.entries[tile_id]
+            if entries:
+                last_id, last_offset, last_length, run_length = entries[-1]
+                if tile_id == last_id + run_length and offset == last_offset:
+                    entries[-1] = (last_id, last_offset, last_length, run_length + 1)
+                    continue
+            entries.append((tile_id, offset, length, 1))
+        root, leaves = build_directories(entries)
+
+        min_lon, min_lat, max_lon, max_lat = self.bounds
+        zooms = [self.min_zoom or 0, self.max_zoom or 0]
+        metadata = gzip.compress(json.dumps({
+            'name': os.path.splitext(os.path.basename(self.path))[0],
+            'format': self.encoder.format,
+            'type': 'baselayer',
+        }).encode(), mtime=0)
+        root_offset = PMTILES_HEADER_SIZE
+        metadata_offset = root_offset + len(root)
+        leaves_offset = metadata_offset + len(metadata)
+        data_offset = leaves_offset + len(leaves)
+        header = struct.pack(
+            '<7sBQQQQQQQQQQQBBBBBBiiiiBii', b'PMTiles', 3,
+            root_offset, len(root), metadata_offset, len(metadata), leaves_offset, len(leaves),
+            data_offset, self.data_size, len(self.entries), len(entries), len(self.contents),
+            0,  # 瓦片数据按写入顺序排列，不是按 tile_id 聚集的
+            2,  # 目录和元数据使用 gzip 压缩
+            1,  # PNG/WebP 瓦片本身不再压缩
+            self.encoder.pmtiles_type,
+            zooms[0], zooms[1],
+            round(min_lon * 1e7), round(min_lat * 1e7), round(max_lon * 1e7), round(max_lat * 1e7),
+            zooms[0], round((min_lon + max_lon) / 2 * 1e7), round((min_lat + max_lat) / 2 * 1e7))
+
+        with open(self.path, 'wb') as f:
+            f.write(header)
+            f.write(root)
+            f.write(metadata)
+            f.write(leaves)
+            self.data.seek(0)
+            shutil.copyfileobj(self.data, f)
+        self.data.close()
+        os.remove(self.data_path)
+
+
+class QueueSink:
+    """
+    工作进程一侧的代理：编码后把瓦片放入队列，由父进程写入不支持并发写入的输出。
+    """
+
+    concurrent = True
+
+    def __init__(self, queue, encoder):
+        self.queue = queue
+        self.encoder = encoder
+
+    def write(self, z, x, y, img, stats):
+        self.queue.put((z, x, y, encode_tile(self.encoder, z, img, stats)))
+
+
+SINKS = {
+    'dir': DirectorySink,
+    'mbtiles': MBTilesSink,
+    'pmtiles': PMTilesSink,
+}
+
+
+def open_sink(path, fmt=None, bounds=None, min_zoom=None, max_zoom=None, encoder=None, update=False):
+    """
+    打开瓦片输出。fmt 为 None 时按扩展名判断：.mbtiles、.pmtiles，其余按目录输出。
+    update 为 True 时在已有输出上增量更新。
+    """
+    if fmt is None:
+        ext = os.path.splitext(path)[1].lower().lstrip('.')
+        fmt = ext if ext in SINKS else 'dir'
+    if fmt == 'dir':
+        return DirectorySink(path, encoder)
+    return SINKS[fmt](path, bounds, min_zoom, max_zoom, encoder, update)
@@ -0,0 +1,64 @@
+import math
+from constants import *
+
+
+def lonlat_to_tile(z, lon, lat):
+    """
+    Convert longitude and latitude to tile x, y at zoom level z.
+    """
+    n = ZOOM_BASE ** z
+    x_tile = int((lon + 180.0) / 360.0 * n)
+    lat_rad = math.radians(lat)
+    y_tile = int((1.0 - math.log(math.tan(lat_rad) + (1 / math.cos(lat_rad))) / math.pi) / 2.0 * n)
+    # Clamp y_tile to [0, 2^z -1]
+    y_tile = max(0, min(int(n) - 1, y_tile))
+    return x_tile, y_tile
+
+
+def tile_span(z):
+    """
+    缩放级别 z 下一个瓦片在 Web Mercator 中的边长（米）。
+    """
+    return 2 * MERCATOR_EXTENT / ZOOM_BASE ** z
+
+
+def tile_bounds(z, x, y):
+    """
+    瓦片 (z, x, y) 在 Web Mercator 中的边界 (min_x, min_y, max_x, max_y)，直接由瓦片号计算，无需经纬度往返。
+    """
+    span = tile_span(z)
+    min_x = -MERCATOR_EXTENT + x * span
+    max_y = MERCATOR_EXTENT - y * span
+    return (min_x, max_y - span, min_x + span, max_y)
+
+
+def tile_range_for_bounds(z, bbox):
+    """
+    缩放级别 z 下与 Web Mercator 边界 bbox 相交的瓦片范围 (x_start, x_end, y_start, y_end)。
+    """
+    span = tile_span(z)
+    last = ZOOM_BASE ** z - 1
+    min_x, min_y, max_x, max_y = bbox
+    x_start = max(0, min(last, int((min_x + MERCATOR_EXTENT) // span)))
+    x_end = max(0, min(last, int((max_x + MERCATOR_EXTENT) // span)))
+    y_start = max(0, min(last, int((MERCATOR_EXTENT - max_y) // span)))
+    y_end = max(0, min(last, int((MERCATOR_EXTENT - min_y) // span)))
+    return x_start, x_end, y_start, y_end
+
+
+def metatile_bounds(z, x, y, size):
+    """
+    以瓦片 (z, x, y) 为左上角的 size×size 元瓦片在 Web Mercator 中的边界。
+    """
+    min_x, _, _, max_y = tile_bounds(z, x, y)
+    _, min_y, max_x, _ = tile_bounds(z, x + size - 1, y + size - 1)
+    return (min_x, min_y, max_x, max_y)
+
+
+def tile_affine(z, x, y, size=TILE_SIZE):
+    """
+    瓦片 (z, x, y) 从 Web Mercator 到像素坐标的仿射变换参数 (origin_x, origin_y, scale)：
+    px = (x - origin_x) * scale, py = (origin_y - y) * scale。
+    """
+    min_x, _, _, max_y = tile_bounds(z, x, y)
+    return min_x, max_y, size / tile_span(z)
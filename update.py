@@ -0,0 +1,239 @@
+import argparse
+import sys
+import osmium
+from constants import *
+from feature_store import FeatureStore
+from labels import load_font
+from main import (OSMHandler, RESAMPLING, render_tile_set, rebuild_overviews, merge_tile_stats,
+                  print_tile_report, is_dense_file_index, pyramid_zoom)
+from profiling import timed
+from raster import RENDERERS, get_renderer
+from style import DEFAULT_STYLE, load_style
+from tile_encoder import add_encoder_arguments, encoder_from_args
+from tile_sink import open_sink, SINKS
+from tilegrid import tile_range_for_bounds
+
+MIN_ZOOM, MAX_ZOOM = 1, 18
+
+
+class DirtyTiles:
+    """
+    按缩放级别记录需要重新渲染的瓦片。
+    """
+
+    def __init__(self, min_zoom=MIN_ZOOM, max_zoom=MAX_ZOOM):
+        self.min_zoom = min_zoom
+        self.max_zoom = max_zoom
+        self.tiles = {z: set() for z in range(min_zoom, max_zoom + 1)}
+
+    def add(self, bbox, min_zoom, max_zoom):
+        """
+        将 [min_zoom, max_zoom] 各级中与 Web Mercator 边界 bbox 相交的瓦片标记为脏瓦片。
+        瓦片的内容只取决于索引边界与其相交的要素，所以这正是受影响的瓦片。
+        """
+        for z in range(max(min_zoom, self.min_zoom), min(max_zoom, self.max_zoom) + 1):
+            x_start, x_end, y_start, y_end = tile_range_for_bounds(z, bbox)
+            self.tiles[z].update((x, y) for x in range(x_start, x_end + 1) for y in range(y_start, y_end + 1))
+
+    def propagate_to_parent(self, z):
+        """
+        概览级别的瓦片由子瓦片缩小得到，z 级的脏瓦片即 z+1 级脏瓦片的父瓦片。
+        """
+        self.tiles[z] = {(x // 2, y // 2) for x, y in self.tiles[z + 1]}
+
+
+class TrackingIndex:
+    """
+    包装要素库：插入新要素的同时把它的边界和缩放级别范围记为脏区域。
+    """
+
+    def __init__(self, store, dirty):
+        self.store = store
+        self.dirty = dirty
+        self.updatable = store.updatable
+
+    def insert(self, item, bbox, min_zoom, max_zoom, osm_id=None):
+        self.store.insert(item, bbox, min_zoom, max_zoom, osm_id=osm_id)
+        self.dirty.add(bbox, min_zoom, max_zoom)
+
+    def add_way(self, way_id, tags, node_ids):
+        self.store.add_way(way_id, tags, node_ids)
+
+
+class ChangeHandler(OSMHandler):
+    """
+    将 OSM 变更文件应用到要素库：变更中出现的每条路径先删除其旧要素（旧边界记为脏区域），
+    未被删除的再按 OSMHandler.way 的规则重新分类、入库（新边界同样记为脏区域）。
+
+    变更文件中移动的节点通常不带其所属路径。应用完变更后，按要素库记录的节点 -> 路径关系
+    找到这些路径，用记录的标签和节点列表、节点索引中的新坐标以同样的方式重新入库。
+    变更文件不包含多边形关系的全部成员路径，无法组装多边形，所以多边形关系不做增量更新，
+    需要时用 main.py --rebuild-store 重建要素库。
+    """
+
+    def __init__(self, store, dirty, font_path, style=None):
+        super(ChangeHandler, self).__init__(TrackingIndex(store, dirty), font_path, multipolygons=False, style=style)
+        self.store = store
+        self.dirty = dirty
+        self.seen = set()
+        self.nodes = set()
+        self.modified = 0
+        self.moved = 0
+        self.deleted = 0
+        self.skipped = 0
+
+    def node(self, n):
+        self.nodes.add(n.id)
+
+    def way(self, w):
+        if not w.deleted and not all(node.location.valid() for node in w.nodes):
+            print(f"Way {w.id}: missing node locations, keeping the stored version.")
+            self.skipped += 1
+            return
+        # 同一路径的多个版本：先写入之前排队的版本，再整体替换
+        if w.id in self.seen:
+            self.flush()
+        self.seen.add(w.id)
+        self.replace(w.id)
+        if w.deleted:
+            self.deleted += 1
+            return
+        self.modified += 1
+        super(ChangeHandler, self).way(w)
+
+    def replace(self, way_id):
+        """
+        删除路径的旧要素和记录，旧边界记为脏区域。
+        """
+        for bbox, min_zoom, max_zoom in self.store.remove(way_id):
+            self.dirty.add(bbox, min_zoom, max_zoom)
+        self.store.remove_way(way_id)
+
+    def apply_file(self, filename, locations=True, idx=None):
+        super(ChangeHandler, self).apply_file(filename, locations=locations, idx=idx)
+        self.update_parent_ways(osmium.index.create_map(idx))
+
+    def update_parent_ways(self, locations):
+        """
+        重新入库变更文件中的节点所属、但本身没有出现在变更文件中的路径。
+        locations 为应用变更后的节点索引。
+        """
+        for way_id in sorted(self.store.parent_ways(self.nodes) - self.seen):
+            tags, node_ids = self.store.get_way(way_id)
+            try:
+                points = [locations.get(node_id) for node_id in node_ids]
+            except KeyError:
+                points = None
+            if points is None or not all(point.valid() for point in points):
+                print(f"Way {way_id}: missing node locations, keeping the stored version.")
+                self.skipped += 1
+                continue
+            self.seen.add(way_id)
+            self.replace(way_id)
+            self.moved += 1
+            coords = [(point.lon, point.lat) for point in points]
+            with timed(self.stats, 'classify'):
+                self.queue_way(way_id, tags, coords, self.style.classify(tags))
+                self.store.add_way(way_id, tags, node_ids)
+            if len(self._pending) >= self.batch_size:
+                self.flush()
+        self.flush()
+
+
+def merge_bounds(a, b):
+    if a is None or b is None:
+        return a or b
+    return (min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3]))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Apply an OSM change file (.osc) to a feature store and re-render only the affected tiles.")
+    parser.add_argument('changes', help="OSM change file (.osc / .osc.gz)")
+    parser.add_argument('--store', required=True, help="SQLite feature store built by main.py --store --updatable")
+    parser.add_argument('--node-index', required=True,
+                        help="the dense file-backed node location index used when the store was built, "
+                             "dense_file_array,<path>; it is updated with the nodes in the change file")
+    parser.add_argument('-o', '--output', default='tile',
+                        help="existing z/x/y.png directory or .mbtiles archive to update (default: tile)")
+    parser.add_argument('--format', choices=sorted(SINKS), help="output format; inferred from --output by default")
+    parser.add_argument('--font', default=FONT_PATH, help="font used for labels")
+    parser.add_argument('--style', default=DEFAULT_STYLE,
+                        help="the style the feature store was built with (default: style.json)")
+    parser.add_argument('--renderer', choices=sorted(RENDERERS), default='pillow',
+                        help="the rasterization backend the output was rendered with (default: pillow)")
+    parser.add_argument('--metatile', type=int, default=1, metavar='N',
+                        help="re-render in N×N metatiles, as main.py --metatile (default: 1)")
+    parser.add_argument('--pyramid-zoom', type=pyramid_zoom, metavar='Z',
+                        help="the --pyramid-zoom the output was built with; zooms below Z are rebuilt "
+                             "from their child tiles")
+    parser.add_argument('--resample', choices=sorted(RESAMPLING), default='lanczos',
+                        help="resampling filter for downsampled overview tiles (default: lanczos)")
+    add_encoder_arguments(parser)
+    args = parser.parse_args()
+    if args.metatile < 1 or args.metatile & (args.metatile - 1):
+        parser.error("--metatile must be a power of two")
+    if not is_dense_file_index(args.node_index):
+        parser.error("--node-index must be the dense file-backed index the store was built with, "
+                     "dense_file_array,<path>; sparse indexes return the old location of moved nodes")
+    try:
+        style = load_style(args.style)
+        renderer = get_renderer(args.renderer)
+    except (OSError, ValueError) as e:
+        parser.error(str(e))
+
+    # 应用变更并记录脏瓦片
+    try:
+        store = FeatureStore(args.store)
+    except ValueError as e:
+        parser.error(str(e))
+    if not store.updatable:
+        parser.error(f"feature store '{args.store}' was built without --updatable, rebuild it with "
+                     "main.py --store ... --updatable")
+    dirty = DirtyTiles()
+    handler = ChangeHandler(store, dirty, args.font, style)
+    handler.apply_file(args.changes, locations=True, idx=args.node_index)
+    bbox = merge_bounds(store.get_metadata('bounds'), handler.data_bounds())
+    store.set_metadata('bounds', bbox)
+    store.close()
+    print(f"Applied '{args.changes}': {handler.modified} ways created or modified, {handler.deleted} deleted, "
+          f"{handler.moved} updated for moved nodes, {handler.skipped} skipped.")
+
+    pyramid_zoom = args.pyramid_zoom or MIN_ZOOM
+    for z in range(pyramid_zoom - 1, MIN_ZOOM - 1, -1):
+        dirty.propagate_to_parent(z)
+    for z in range(MIN_ZOOM, MAX_ZOOM + 1):
+        if dirty.tiles[z]:
+            print(f"Zoom {z}: {len(dirty.tiles[z])} dirty tiles")
+
+    # 只重新渲染脏瓦片
+    index = FeatureStore(args.store, readonly=True)
+    font = load_font(args.font)
+    sink = open_sink(args.output, args.format, bbox, MIN_ZOOM, MAX_ZOOM, encoder_from_args(args), update=True)
+    saved, failures, tile_stats = 0, [], {}
+    for z in range(pyramid_zoom, MAX_ZOOM + 1):
+        if not dirty.tiles[z]:
+            continue
+        z_saved, z_failures, z_stats = render_tile_set(z, dirty.tiles[z], index, font, sink, args.metatile,
+                                                       delete_empty=True, style=style, renderer=renderer)
+        saved += z_saved
+        failures.extend(z_failures)
+        merge_tile_stats(tile_stats, z_stats)
+    for z in range(pyramid_zoom - 1, MIN_ZOOM - 1, -1):
+        if not dirty.tiles[z]:
+            continue
+        z_saved, z_failures, z_stats = rebuild_overviews(z, sorted(dirty.tiles[z]), sink,
+                                                         RESAMPLING[args.resample], delete_empty=True,
+                                                         background=style.background)
+        saved += z_saved
+        failures.extend(z_failures)
+        merge_tile_stats(tile_stats, z_stats)
+    sink.close()
+
+    print_tile_report(tile_stats)
+    for z, x, y, error in failures:
+        print(f"Failed tile {z}/{x}/{y}: {error}")
+    if failures:
+        print(f"Re-rendered {saved} tiles, {len(failures)} failed.")
+        sys.exit(1)
+    print(f"Re-rendered {saved} tiles.")